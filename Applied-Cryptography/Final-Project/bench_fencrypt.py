@@ -0,0 +1,298 @@
+'''
+Benchmarks
+
+Times each fencrypt phase (key derivation, Feistel encrypt and decrypt,
+search-term generation, search) on synthetic binary and text inputs and
+writes the results as JSON. Each phase also runs once more in a fresh
+interpreter to record its peak RSS, which catches mmap pages and C buffers
+that tracemalloc cannot see. The results are written so runs on different commits can be compared:
+
+    python bench_fencrypt.py --sizes 32,1M,64M -o before.json
+    python bench_fencrypt.py --sizes 32,1M,64M -o after.json --compare before.json
+'''
+
+import json
+import multiprocessing
+import multiprocessing.forkserver
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from argparse import ArgumentParser
+from pathlib import Path
+from random import Random
+from typing import Callable
+
+import fencrypt
+from fencrypt import (KeyContext, feistel_decrypt_stream, feistel_encrypt_stream,
+                      gen_search_terms, key_contexts, mapped, parse_query, search_file,
+                      staged_file)
+
+PWD = b"benchmark"
+SALT = bytes(range(16))
+UNITS = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30}
+QUERIES = ["crickets", "θήβαις", "straße", "benchmark", "zzzzzzzz", "abcd*", "xyzw*"]
+
+def parse_size(s: str) -> int:
+    s = s.strip().upper()
+    if s[-1] in UNITS:
+        return int(float(s[:-1]) * UNITS[s[-1]])
+    return int(s)
+
+def gen_binary(path: Path, size: int, seed: int):
+    '''
+    Write `size` pseudo-random bytes, a chunk at a time
+    '''
+    rng = Random(seed)
+    with path.open("wb") as f:
+        left = size
+        while left:
+            n = min(left, 1 << 20)
+            f.write(rng.randbytes(n))
+            left -= n
+
+def gen_vocabulary(rng: Random, n: int = 20_000) -> "list[str]":
+    '''
+    Random words of 2-16 code points, mostly ASCII with some Greek and
+    accented Latin so the Unicode normalization paths are exercised
+    '''
+    alphabets = ["abcdefghijklmnopqrstuvwxyz"] * 6 + ["αβγδεζηθικλμνξοπρστυφχψω", "àáâäçèéêëßñöüæø"]
+    words = []
+    for _ in range(n):
+        letters = rng.choice(alphabets)
+        word = "".join(rng.choice(letters) for _ in range(rng.randint(2, 16)))
+        words.append(word.capitalize() if rng.random() < 0.1 else word)
+    return words + QUERIES[:4]
+
+def gen_text(path: Path, size: int, seed: int):
+    '''
+    Write about `size` bytes of UTF-8 text made of lines of random words
+    '''
+    rng = Random(seed)
+    vocab = gen_vocabulary(rng)
+    with path.open("wb") as f:
+        written = 0
+        while written < size:
+            lines = []
+            for _ in range(1000):
+                lines.append(" ".join(rng.choices(vocab, k=rng.randint(4, 16))) + ".\n")
+            chunk = "".join(lines).encode("utf-8")[:size - written]
+            # never cut a multi-byte character in half
+            chunk = chunk.decode("utf-8", "ignore").encode("utf-8")
+            if not chunk:
+                chunk = b" " * (size - written)
+            f.write(chunk)
+            written += len(chunk)
+
+def measure(fn: Callable[[], None], setup: Callable[[], None], repeat: int) -> "tuple[float, int]":
+    '''
+    Best wall time of `repeat` runs of `fn`, then its peak Python heap use
+    from one more run under tracemalloc. `setup` runs untimed before each.
+    '''
+    best = float("inf")
+    for _ in range(repeat):
+        setup()
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    setup()
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return best, peak
+
+def max_rss() -> int:
+    '''
+    Peak resident set size of this process in bytes
+    '''
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # linux reports kilobytes, macOS bytes
+    return rss if sys.platform == "darwin" else rss * 1024
+
+def phase_fns(kind: str, workdir: Path, ctx: KeyContext) -> "dict[str, Callable[[], None]]":
+    '''
+    The benchmarked phases over the files in `workdir`, by name.
+    Each one expects its setup from bench_file to have run first.
+    '''
+    src = workdir / f"input.{kind}"
+    work = workdir / f"work.{kind}"
+    keys = ctx.keys
+
+    def encrypt():
+        with mapped(work) as buf, staged_file(work) as out:
+            feistel_encrypt_stream(keys, buf, out)
+        os.replace(out.name, work)
+
+    def decrypt():
+        with mapped(work) as buf, staged_file(work) as out:
+            feistel_decrypt_stream(keys, buf, out)
+        os.replace(out.name, work)
+
+    return {
+        "kdf": lambda: KeyContext(PWD, SALT),
+        "encrypt": encrypt,
+        "decrypt": decrypt,
+        "terms": lambda: gen_search_terms(src, keys["search"]),
+        "search": lambda: search_file(".fenc-meta.work.text", PWD, parse_query(QUERIES)),
+    }
+
+# ru_maxrss only ever grows and is carried over by fork and exec, so each
+# phase runs in a process forked from a server started before any input
+# was generated
+rss_procs = multiprocessing.get_context("forkserver")
+
+def run_phase(phase: str, kind: str, workdir: Path, threads: int, conn):
+    '''
+    Run one phase in this process and send back its peak RSS from before
+    and after the phase
+    '''
+    os.chdir(workdir)
+    fencrypt.set_cipher_threads(threads)
+    ctx = KeyContext(PWD, SALT)
+    key_contexts[(PWD, SALT)] = ctx
+    fn = phase_fns(kind, workdir, ctx)[phase]
+    base = max_rss()
+    fn()
+    conn.send((base, max_rss()))
+
+def measure_rss(phase: str, kind: str, workdir: Path, threads: int) -> "tuple[int, int]":
+    '''
+    Peak RSS of a fresh process running `phase` once, and its peak before
+    the phase started (interpreter, imports, key derivation)
+    '''
+    recv, send = rss_procs.Pipe(duplex=False)
+    proc = rss_procs.Process(target=run_phase, args=(phase, kind, workdir, threads, send))
+    proc.start()
+    send.close()
+    try:
+        base, peak = recv.recv()
+    except EOFError:
+        base = peak = None
+    proc.join()
+    if base is None:
+        raise RuntimeError(f"{phase} phase exited with code {proc.exitcode}")
+    return peak, base
+
+def bench_file(kind: str, size: int, workdir: Path, repeat: int, threads: int) -> "list[dict]":
+    src = workdir / f"input.{kind}"
+    (gen_text if kind == "text" else gen_binary)(src, size, seed=size)
+    work = workdir / f"work.{kind}"
+    ctx = KeyContext(PWD, SALT)
+    keys = ctx.keys
+    fns = phase_fns(kind, workdir, ctx)
+    results = []
+
+    def record(phase: str, fn: Callable[[], None], setup: Callable[[], None] = lambda: None):
+        seconds, peak = measure(fn, setup, repeat)
+        setup()
+        rss, rss_base = measure_rss(phase, kind, workdir, threads)
+        results.append({
+            "phase": phase,
+            "kind": kind,
+            "size": size,
+            "seconds": seconds,
+            "mb_per_s": size / seconds / 1e6 if seconds else None,
+            "peak_bytes": peak,
+            "rss_bytes": rss,
+            "rss_base_bytes": rss_base,
+        })
+        print(f"{kind:6} {size:>12} {phase:10} {seconds:10.4f}s {peak:>12} B peak "
+              f"{rss:>12} B rss", file=sys.stderr)
+
+    def fresh_copy():
+        shutil.copyfile(src, work)
+
+    def encrypted_copy():
+        fresh_copy()
+        fns["encrypt"]()
+
+    record("kdf", fns["kdf"])
+    record("encrypt", fns["encrypt"], fresh_copy)
+    record("decrypt", fns["decrypt"], encrypted_copy)
+    if kind == "text":
+        terms = []
+
+        def search_terms():
+            terms[:] = fns["terms"]()
+
+        record("terms", search_terms)
+        md = {"salt": SALT.hex(), "validator": keys["val"].hex(), "mac": "00" * 32, "terms": terms}
+        (workdir / ".fenc-meta.work.text").write_text(json.dumps(md, indent=4), encoding="utf-8")
+        (workdir / ".fenc-terms.work.text").write_bytes(b"".join(bytes.fromhex(t) for t in terms))
+        # key derivation is timed separately, so search starts with a warm key
+        key_contexts[(PWD, SALT)] = ctx
+        record("search", fns["search"])
+        results[-1]["terms"] = len(terms)
+        key_contexts.clear()
+    return results
+
+def git_commit() -> str:
+    try:
+        out = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                             text=True, cwd=Path(__file__).parent)
+        return out.stdout.strip()
+    except OSError:
+        return ""
+
+def compare(base: dict, new: dict):
+    '''
+    Print the speedup of each phase in `new` over the same phase in `base`
+    '''
+    old = {(r["phase"], r["kind"], r["size"]): r for r in base["results"]}
+    print(f"{'kind':6} {'size':>12} {'phase':10} {'base s':>10} {'new s':>10} {'speedup':>8}")
+    for r in new["results"]:
+        b = old.get((r["phase"], r["kind"], r["size"]))
+        if b:
+            speedup = b["seconds"] / r["seconds"] if r["seconds"] else float("inf")
+            print(f"{r['kind']:6} {r['size']:>12} {r['phase']:10} {b['seconds']:10.4f} "
+                  f"{r['seconds']:10.4f} {speedup:7.2f}x")
+
+def main():
+    parser = ArgumentParser(description="Benchmark fencrypt phases")
+    parser.add_argument("--sizes", default="32,4K,1M,16M", help="comma separated, K/M/G suffixes")
+    parser.add_argument("--kinds", default="binary,text", help="binary, text or both")
+    parser.add_argument("--repeat", type=int, default=3, help="timed runs per phase (best is kept)")
+    parser.add_argument("--threads", type=int, default=1, help="cipher threads per file")
+    parser.add_argument("--workdir", default="", help="where inputs are generated (default: a temp dir)")
+    parser.add_argument("-o", "--output", default="bench_results.json", help="JSON results file")
+    parser.add_argument("--compare", default="", metavar="BASE", help="results file to compare against")
+    args = parser.parse_args()
+
+    # measure fencrypt itself, not a running key agent
+    os.environ.pop("FENC_AGENT_SOCK", None)
+    fencrypt.set_cipher_threads(args.threads)
+    multiprocessing.forkserver.ensure_running()
+    workdir = Path(args.workdir or tempfile.mkdtemp(prefix="fenc-bench-"))
+    workdir.mkdir(parents=True, exist_ok=True)
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        results = []
+        for kind in args.kinds.split(","):
+            for size in map(parse_size, args.sizes.split(",")):
+                results += bench_file(kind, size, workdir, args.repeat, args.threads)
+    finally:
+        os.chdir(cwd)
+        if not args.workdir:
+            shutil.rmtree(workdir)
+    report = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "chunk_size": fencrypt.CHUNK_SIZE,
+        "threads": args.threads,
+        "results": results,
+    }
+    with open(args.output, "w", encoding="utf-8") as f:
+        f.write(json.dumps(report, indent=4) + "\n")
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            compare(json.load(f), report)
+
+if __name__ == "__main__": main()
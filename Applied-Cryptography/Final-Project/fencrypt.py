@@ -1,63 +1,104 @@
 import json
 import sys
 import hmac
+import atexit
+import io
+import os
+import queue
+import shutil
+import signal
+import struct
+import threading
+import time
+import zlib
+from codecs import getincrementaldecoder
+from collections import OrderedDict, deque
+from mmap import mmap, ACCESS_READ
+from contextlib import contextmanager, redirect_stderr, redirect_stdout
+from itertools import repeat
 from getpass import getpass
 from secrets import token_bytes
 from argparse import ArgumentParser, Namespace
 from pathlib import Path
-from Crypto.Cipher import AES
-from unicodedata import normalize
 from hashlib import pbkdf2_hmac
-from typing import Union
-from regex import findall
+from typing import Callable, Union
+# regex, AES, unicodedata, sqlite3, multiprocessing and the socket modules are
+# imported where they are used, so a run only pays for what it needs
+
+# Feistel rounds stream the file in chunks of this many bytes (a multiple of
+# the AES block size) so memory use does not grow with the file size.
+CHUNK_SIZE = 1 << 20
+
+# a searchable word: 4-12 of these code points
+WORD_PATTERN = r"[\p{L}\p{Mn}\p{Nd}\p{Pc}]+"
+
+# binary metadata: magic, version, salt, validator, mac, length of the JSON
+# block of any other fields, term count; then that block, the raw terms and,
+# for a chunked file, the raw chunk macs ("chunk_count" in the JSON block)
+META_MAGIC = b"FENCMETA"
+META_VERSION = 1
+META_HEADER = struct.Struct(">8sB16s16s32sIQ")
+
+# per-directory SQLite catalog of the encrypted files (see Catalog)
+CATALOG_NAME = ".fenc-catalog"
+
+# compression that can run before the Feistel rounds (--compress)
+COMPRESSIONS = ("zlib",)
+
+# how long a client waits on the key agent before deriving the key itself
+AGENT_TIMEOUT = 2.0
+
+# threads running the keystream XORs of one file, a chunk each, and
+# their pool (created on first use); see set_cipher_threads
+cipher_threads = 1
+cipher_pool = None
 
 ####################
 ### Encrypt task ###
 ####################
 
 class Encrypt:
-    def __init__(self, fpath: Path, pwd: bytes = b"", j_flag: bool=False, salt: bytes = b""):
+    def __init__(self, fpath: Path, pwd: bytes = b"", j_flag: bool=False, salt: bytes = b"",
+                 meta_format: str = "json", chunk_size: int = 0, compression: str = ""):
         if not pwd:
             exit_error("Error: Must supply password to encrypt.")
         self.path = fpath
+        self.meta_format = meta_format
+        self.chunk_size = chunk_size
+        self.compression = compression
         self.pwd = pwd
         self.keys = {}
         self.metadata = {}
-        self.searchable = is_text(fpath)
         name = f'.fenc-meta.{fpath.name}'
         self.name = name
-        if not fpath.exists():
-            error_msg("Error: No such file.")
-        with fpath.open("r+b") as f:
-            plaintext = f.read()
-            f.close()
-        self.plaintext = plaintext
         self.j_flag = j_flag
-        mk = masterkey(self, salt_gen())
-        j_master_keys = {self.path.name: mk.hex()}
-        if self.j_flag: 
-            print(json.dumps(j_master_keys, indent=4), file=sys.stdout)
-        self.__encrypt(plaintext, salt)
+        self.staged = None
+        if get_metadata_file(fpath).exists():
+            exit_error(f"Error: {fpath} Already Encrypted.")
+        with tracking(fpath.name, "encrypt"):
+            if not fpath.exists():
+                error_msg("Error: No such file.")
+            # one mapping feeds text detection, word extraction and the cipher
+            with mapped(fpath) as buf:
+                with timed("text_scan", len(buf)):
+                    words = text_words(buf)
+                self.searchable = words is not None
+                ctx = key_context(pwd, salt or salt_gen())
+                j_master_keys = {self.path.name: ctx.mk.hex()}
+                if self.j_flag: 
+                    print(json.dumps(j_master_keys, indent=4), file=sys.stdout)
+                self.__encrypt(ctx, buf, words)
+            os.replace(self.staged, fpath)
 
-    def __gen_search_terms(self):
+    def __gen_search_terms(self, words: "Union[set[str], None]"):
         '''
         Generate the star search term macs
         '''
         if not self.searchable:
             self.metadata["terms"] = []
         else:
-            plaintext = self.plaintext.decode("utf-8")
-            uni_cats = r"[\p{L}\p{Mn}\p{Nd}\p{Pc}]+"
-            words = findall(uni_cats, plaintext)
-            words = filter(lambda w: 4 <= len(w) <= 12, words)
-            terms = []
-            for w in words:
-                terms += map(lambda t: normalize("NFC", t.casefold()), gen_star_terms(w))
-            macs = set()
-            for t in terms:
-                mac = hash_mac(self.keys["search"], t.encode("utf-8"))
-                macs.add(mac)
-            self.metadata["terms"] = sorted(macs)
+            with timed("search_terms"):
+                self.metadata["terms"] = search_term_macs(words, self.keys["search"])
 
     def prep_metadata(self):
         '''
@@ -68,31 +109,77 @@ class Encrypt:
         md["salt"] = md["salt"].hex()
         md["validator"] = md["validator"].hex()
     
-    def __write_metadata_file(self):
-        name = self.name
-        md_file_path = Path.cwd() / name
-        md_fd = open(md_file_path, "w", encoding="utf-8")
+    def __write_metadata_file(self) -> dict:
+        '''
+        Write the metadata; returns the file's catalog entry
+        '''
+        md_file_path = get_metadata_file(self.path)
         self.prep_metadata()
-        md_fd.write(json.dumps(self.metadata, indent=4))
-        md_fd.close()
-
-    def __encrypt(self, plaintext: bytes, salt: bytes = b""):
-        key_sched(self, masterkey(self, salt))
-        self.__gen_search_terms()
-        key_1, key_2, key_3, key_4 = self.keys["feistel"]
-        mac_key = self.keys["mac"]
-        left0 = plaintext[:16]  # iv
-        right0 = plaintext[16:] # message to be encrypted
-        left1, right1 = aes_rd(key_1, left0, right0)
-        left2, right2 = hmac_rd(key_2, left1, right1)
-        left3, right3 = aes_rd(key_3, left2, right2)
-        left4, right4 = hmac_rd(key_4, left3, right3)
-        ct =  left4 + right4
-        self.metadata["mac"] = hash_mac(mac_key, ct)
-        self.__write_metadata_file()
-        with self.path.open("wb") as f:
-            f.write(ct)
+        entry = {k: self.metadata[k] for k in ("salt", "validator", "mac")}
+        with timed("metadata_write"):
+            if self.meta_format == "binary":
+                entry["terms_offset"] = write_binary_metadata(md_file_path, self.metadata)
+                entry["terms_count"] = len(self.metadata["terms"])
+                return entry
+            md_fd = open(md_file_path, "x", encoding="utf-8")
+            md_fd.write(json.dumps(self.metadata, indent=4))
+            md_fd.close()
+        return entry
+
+    def __write_term_index(self):
+        '''
+        Write the sorted raw term macs next to the metadata for `TermIndex`;
+        files with no terms (not text) get no index
+        '''
+        if not self.metadata["terms"]:
+            return
+        index_path = get_metadata_file(self.path, ".fenc-terms.")
+        with timed("metadata_write"), index_path.open("wb") as f:
+            f.write(b"".join(bytes.fromhex(t) for t in self.metadata["terms"]))
             f.close()
+
+    def __encrypt(self, ctx: "KeyContext", buf: Union[bytes, mmap], words: "Union[set[str], None]"):
+        self.metadata["salt"] = ctx.salt
+        self.metadata["validator"] = ctx.keys["val"]
+        self.keys = ctx.keys
+        self.__gen_search_terms(words)
+        # search terms above come from the plaintext, the cipher runs on `src`
+        with compressed(buf, self.compression, self.path) as src, staged_file(self.path) as out:
+            if self.chunk_size:
+                mac, chunk_macs = encrypt_chunks(self.keys, src, out, self.chunk_size)
+                self.metadata["mac"] = mac
+                self.metadata["chunk_size"] = self.chunk_size
+                self.metadata["chunk_macs"] = chunk_macs
+            else:
+                self.metadata["mac"] = feistel_encrypt_stream(self.keys, src, out)
+            if src is not buf:
+                self.metadata["compression"] = self.compression
+        self.staged = Path(out.name)
+        md_file_path = get_metadata_file(self.path)
+        # the metadata is written before the ciphertext replaces the plaintext,
+        # and created exclusively: a file whose metadata name was taken since
+        # the check in __init__ (another worker, or an examples/ file sharing
+        # its parent's name) is refused rather than overwritten
+        try:
+            entry = self.__write_metadata_file()
+        except FileExistsError:
+            self.staged.unlink()
+            exit_error(f"Error: {self.path} Already Encrypted.")
+        except BaseException:
+            self.staged.unlink()
+            md_file_path.unlink(missing_ok=True)
+            raise
+        try:
+            if self.meta_format != "binary":
+                # binary metadata carries its own term table
+                self.__write_term_index()
+            with timed("catalog"), Catalog(md_file_path.parent) as catalog:
+                catalog.put(self.path.name, entry)
+        except BaseException:
+            self.staged.unlink()
+            md_file_path.unlink()
+            get_metadata_file(self.path, ".fenc-terms.").unlink(missing_ok=True)
+            raise
         # print(f"Success! {self.path.name} is encrypted.", file=sys.stderr)
 
 ####################
@@ -100,42 +187,50 @@ class Encrypt:
 ####################
 
 class Decrypt:
-    def __init__(self, fpath: Path, pwd: bytes, j_flag: bool):
-        self.metadata = read_metadata(fpath.name)
+    def __init__(self, fpath: Path, pwd: bytes, j_flag: bool, commit: bool = True):
         self.pwd = pwd
         self.keys = {}
         self.terms = []
         self.path = fpath
         self.enc_file = fpath.name
         self.j_flag = j_flag
-        self.decrypt()
+        self.staged = None
+        with tracking(fpath.name, "decrypt"):
+            self.metadata = read_metadata(str(fpath), terms=False)
+            self.decrypt()
+        # with commit=False the plaintext is left in `self.staged` for
+        # `commit_decrypted`, so a batch can check every file first
+        if commit:
+            commit_decrypted(self.path, self.staged)
 
     def decrypt(self):
-        salt = bytes.fromhex(str(self.metadata["salt"]))
-        mk = masterkey(self, salt)
-        key_sched(self, mk)
-        with self.path.open('r+b') as f:
-            ciphertext = f.read()
-            f.close()
-            j_master_keys = {self.enc_file: mk.hex()}
-            if self.j_flag: 
-                print(json.dumps(j_master_keys, indent=4), file=sys.stdout)
-            self.__decrypt(ciphertext)
-
-    def __decrypt(self, ciphertext: bytes):
-        key_1, key_2, key_3, key_4 = self.keys["feistel"]
-        left4 = ciphertext[:16]
-        right4 = ciphertext[16:]
-        left3, right3 = hmac_rd(key_4, left4, right4)
-        left2, right2 = aes_rd(key_3, left3, right3)
-        left1, right1 = hmac_rd(key_2, left2, right2)
-        left0, right0 = aes_rd(key_1, left1, right1)
-        pt = left0 + right0
-        with self.path.open("wb") as f:
-            f.write(pt)
-            f.close()
-        Path.unlink(get_metadata_file(self.path))
-        print(f"Success! {self.path.name} is decrypted.", file=sys.stderr)
+        ctx = key_context(self.pwd, bytes.fromhex(str(self.metadata["salt"])))
+        self.keys = ctx.keys
+        j_master_keys = {self.enc_file: ctx.mk.hex()}
+        if self.j_flag: 
+            print(json.dumps(j_master_keys, indent=4), file=sys.stdout)
+        self.__decrypt()
+
+    def __decrypt(self):
+        # the MAC is checked on the first pass, before anything is written
+        compression = self.metadata.get("compression", "")
+        if compression and compression not in COMPRESSIONS:
+            exit_error(f"Error: unsupported compression {compression}.")
+        with mapped(self.path) as buf, staged_file(self.path) as out:
+            # compressed plaintext is inflated as the last pass writes it
+            dst = Inflater(out) if compression else out
+            try:
+                if "chunk_size" in self.metadata:
+                    ok = decrypt_chunks(self.keys, buf, dst, self.metadata)
+                else:
+                    ok = feistel_decrypt_stream(self.keys, buf, dst, str(self.metadata["mac"]))
+                if ok and dst is not out:
+                    dst.finish()
+            except (zlib.error, ValueError):
+                exit_error(f"Error: {self.path.name} could not be decompressed.")
+            if not ok:
+                exit_error("")
+        self.staged = Path(out.name)
             
 
 ###################
@@ -143,51 +238,803 @@ class Decrypt:
 ###################
 
 class Search:
-    def __init__(self, terms: "list[str]", j_flag: bool):
+    def __init__(self, terms: "list[str]", j_flag: bool, jobs: int = 1, recursive: bool = False):
         self.metadata = {}
         self.keys = {}
+        try:
+            self.query = parse_query(terms)
+        except ValueError as e:
+            exit_error(f"Error: {e}.")
         self.pwd = get_pwd()
         self.terms = terms
         self.j_flag = j_flag
+        self.jobs = jobs
+        self.recursive = recursive
         self.search()
 
     def search(self):
-        search_macs = []
-        mds = list(Path.cwd().glob(".fenc-meta.*"))
+        from concurrent.futures import ProcessPoolExecutor, as_completed
+        mds = list(find_metadata(self.recursive))
         j_master_keys = {}
-        for md in mds:
-            fname = md.name[len(".fenc-meta."):]
-            mac_key = gen_keys(self, fname)["search"]
-            for t in self.terms:
-                mac = hash_mac(mac_key, t.encode("utf-8"))
-                search_macs.append(mac)
-            md_dict = read_metadata(md.name, False)
-            md_terms = md_dict["terms"]
-            mk = masterkey(self, bytes.fromhex(str(md_dict["salt"])))
-            left, right = mk[:16], mk[-16:]
-            aes = AES.new(left, AES.MODE_ECB)
-            val = aes.encrypt(right)
-            if val.hex() != md_dict["validator"]:
+        if self.jobs > 1 and len(mds) > 1:
+            # matches are printed as each file finishes, not in glob order
+            pool = ProcessPoolExecutor(min(self.jobs, len(mds)))
+            futures = [pool.submit(collect_stats, bool(stats_hooks), search_file, md, self.pwd, self.query, entry)
+                       for md, entry in mds]
+            results = (f.result() for f in as_completed(futures))
+        else:
+            pool = None
+            results = (collect_stats(bool(stats_hooks), search_file, md, self.pwd, self.query, entry)
+                       for md, entry in mds)
+        for (fname, mk, found), stats in results:
+            for st in stats:
+                report_stats(st)
+            if not mk:
                 error_msg(f"{fname}: Password does not match.")
             else:
-                j_master_keys[fname] = mk.hex()
-                for sm in search_macs:
-                    if sm in md_terms:
-                        print(fname)
+                j_master_keys[fname] = mk
+                if found:
+                    print(fname, flush=True)
+        if pool:
+            pool.shutdown()
         if self.j_flag: 
             print(json.dumps(j_master_keys, indent=4), file=sys.stdout)
+
+def search_file(md_name: str, pwd: bytes, query: tuple,
+                entry: "Union[dict, None]" = None) -> "tuple[str, str, bool]":
+    '''
+    Match a `parse_query` tree against one metadata file with a single key
+    derivation, using its catalog `entry` instead of the file if given.
+    Returns the file name, its hex master key ("" if the password is
+    wrong) and whether the file matches.
+    '''
+    md_path = Path(md_name)
+    fname = str(md_path.with_name(md_path.name[len(".fenc-meta."):]))
+    with tracking(fname, "search"):
+        md_dict = entry
+        if not entry or entry.get("inline"):
+            md_dict = read_metadata(md_name, False, terms=False)
+        ctx = key_context(pwd, bytes.fromhex(str(md_dict["salt"])))
+        if ctx.keys["val"].hex() != md_dict["validator"]:
+            return fname, "", False
+        with timed("term_lookup"), TermIndex.load(fname, md_dict) as md_terms:
+            found = query_match(query, term_lookup(ctx.keys["search"], md_terms))
+        return fname, ctx.mk.hex(), found
+
+def parse_query(args: "list[str]") -> tuple:
+    '''
+    Parse search arguments into a tree of ("or", [...]), ("and", [...]),
+    ("not", q) and ("term", t) nodes. NOT binds tightest, then AND, then
+    OR, and parentheses group; terms with no operator between them are
+    OR'd, as a plain list of search terms always was.
+    Raises ValueError if the query is malformed.
+    '''
+    import re
+    from unicodedata import normalize
+    tokens = [t for a in args for t in re.findall(r"[()]|[^\s()]+", a)]
+    pos = 0
+
+    def peek() -> "Union[str, None]":
+        return tokens[pos] if pos < len(tokens) else None
+
+    def or_expr() -> tuple:
+        nonlocal pos
+        nodes = [and_expr()]
+        while peek() not in (None, ")"):
+            if peek() == "OR":
+                pos += 1
+            nodes.append(and_expr())
+        return nodes[0] if len(nodes) == 1 else ("or", nodes)
+
+    def and_expr() -> tuple:
+        nonlocal pos
+        nodes = [not_expr()]
+        while peek() == "AND":
+            pos += 1
+            nodes.append(not_expr())
+        return nodes[0] if len(nodes) == 1 else ("and", nodes)
+
+    def not_expr() -> tuple:
+        nonlocal pos
+        tok = peek()
+        if tok in (None, "AND", "OR", ")"):
+            raise ValueError(f"expected a search term {'before ' + tok if tok else 'at the end'}")
+        pos += 1
+        if tok == "NOT":
+            return ("not", not_expr())
+        if tok == "(":
+            node = or_expr()
+            if peek() != ")":
+                raise ValueError("missing )")
+            pos += 1
+            return node
+        # terms are stored casefolded and NFC normalized
+        return ("term", normalize("NFC", tok.casefold()))
+
+    if not tokens:
+        raise ValueError("empty search query")
+    node = or_expr()
+    if peek() is not None:
+        raise ValueError(f"unexpected {peek()}")
+    return node
+
+def query_match(query: tuple, contains: Callable[[str], bool]) -> bool:
+    '''
+    Evaluate a `parse_query` tree, looking terms up with `contains` and
+    stopping as soon as the result is known
+    '''
+    op, arg = query
+    if op == "term":
+        return contains(arg)
+    if op == "not":
+        return not query_match(arg, contains)
+    if op == "and":
+        return all(query_match(q, contains) for q in arg)
+    return any(query_match(q, contains) for q in arg)
+
+def term_lookup(search_key: bytes, index: "TermIndex") -> Callable[[str], bool]:
+    '''
+    Membership test for one file's terms. The macs are keyed per file, so
+    each term is MACed the first time the query asks for it.
+    '''
+    seen = {}
+
+    def contains(term: str) -> bool:
+        if term not in seen:
+            seen[term] = bytes.fromhex(hash_mac(search_key, term.encode("utf-8"))) in index
+        return seen[term]
+    return contains
             
                             
+###################
+### Library API ###
+###################
+
+def encrypt_bytes(data: bytes, pwd: bytes, salt: bytes = b"", chunk_size: int = 0,
+                  compression: str = "") -> "tuple[bytes, dict]":
+    '''
+    Encrypt `data` (any bytes-like buffer) in memory, in `chunk_size`-byte
+    chunks and compressed first if given. Returns the ciphertext and its
+    metadata, hex-encoded as in a `.fenc-meta.` file.
+    '''
+    if len(data) < 32:
+        raise ValueError("data is too small")
+    ctx = new_key_context(pwd, salt or salt_gen())
+    words = text_words(data)
+    out = io.BytesIO()
+    md = {"salt": ctx.salt.hex(), "validator": ctx.keys["val"].hex()}
+    md["terms"] = [] if words is None else search_term_macs(words, ctx.keys["search"])
+    with compressed(data, compression) as src:
+        if chunk_size:
+            md["mac"], chunk_macs = encrypt_chunks(ctx.keys, src, out, chunk_size)
+            md["chunk_size"] = chunk_size
+            md["chunk_macs"] = chunk_macs
+        else:
+            md["mac"] = feistel_encrypt_stream(ctx.keys, src, out)
+        if src is not data:
+            md["compression"] = compression
+    return out.getvalue(), md
+
+def decrypt_bytes(data: bytes, pwd: bytes, metadata: dict) -> bytes:
+    '''
+    Decrypt `data` in memory with the metadata `encrypt_bytes` returned
+    (or a loaded `.fenc-meta.` file). Raises ValueError if the password or
+    MAC does not match.
+    '''
+    ctx = unlock_metadata(pwd, metadata)
+    out = io.BytesIO()
+    dst = Inflater(out) if metadata.get("compression") else out
+    if "chunk_size" in metadata:
+        ok = decrypt_chunks(ctx.keys, data, dst, metadata)
+    else:
+        ok = feistel_decrypt_stream(ctx.keys, data, dst, str(metadata["mac"]))
+    if not ok:
+        raise ValueError("MAC does not match")
+    if dst is not out:
+        dst.finish()
+    return out.getvalue()
+
+def decrypt_bytes_range(data: bytes, pwd: bytes, metadata: dict, offset: int, length: int) -> bytes:
+    '''
+    Plaintext bytes [offset, offset + length) of chunked ciphertext `data`,
+    decrypting only the chunks they fall in. Raises ValueError if the file
+    is not chunked or the password or a MAC does not match.
+    '''
+    if "chunk_size" not in metadata or metadata.get("compression"):
+        raise ValueError("not an uncompressed chunked file")
+    plain = decrypt_range(unlock_metadata(pwd, metadata).keys, data, metadata, offset, length)
+    if plain is None:
+        raise ValueError("MAC does not match")
+    return plain
+
+def search_metadata(metadata: dict, pwd: bytes, terms: "list[str]") -> "list[str]":
+    '''
+    The `terms` found in the file `metadata` describes, matched casefolded
+    and NFC normalized like `-s` terms. Raises ValueError if the password
+    does not match.
+    '''
+    from unicodedata import normalize
+    ctx = unlock_metadata(pwd, metadata)
+    index = TermIndex(b"".join(sorted(bytes.fromhex(t) for t in metadata.get("terms", []))))
+    contains = term_lookup(ctx.keys["search"], index)
+    return [t for t in terms if contains(normalize("NFC", t.casefold()))]
+
+def match_metadata(metadata: dict, pwd: bytes, query: "list[str]") -> bool:
+    '''
+    Whether the file `metadata` describes matches the boolean search
+    `query`, given as `-s` arguments. Raises ValueError if the password
+    does not match or the query is malformed.
+    '''
+    tree = parse_query(query)
+    ctx = unlock_metadata(pwd, metadata)
+    index = TermIndex(b"".join(sorted(bytes.fromhex(t) for t in metadata.get("terms", []))))
+    return query_match(tree, term_lookup(ctx.keys["search"], index))
+
+def unlock_metadata(pwd: bytes, metadata: dict) -> "KeyContext":
+    ctx = new_key_context(pwd, bytes.fromhex(str(metadata["salt"])))
+    if ctx.keys["val"].hex() != metadata["validator"]:
+        raise ValueError("Password does not match")
+    return ctx
+
+#################
+### Key agent ###
+#################
+
+class KeyAgent:
+    '''
+    Holds master keys in memory and serves them over a Unix socket, like
+    ssh-agent. As with ssh-agent, keys only get there when the user adds
+    them (`--agent-add`, which checks the password first), the owner-only
+    socket is the trust boundary, and while a file's key is held it
+    unlocks with any password. Keys are stored by salt alone; nothing
+    derived from the password is kept, so the agent's memory offers no
+    faster way to guess it than PBKDF2. Entries expire after `ttl`
+    seconds and the least recently used is evicted past `max_keys`.
+    '''
+    def __init__(self, ttl: float = 900, max_keys: int = 1024):
+        self.ttl = ttl
+        self.max_keys = max_keys
+        self.keys: "OrderedDict[str, tuple[bytes, float]]" = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key: str) -> bytes:
+        with self.lock:
+            entry = self.keys.get(key)
+            if entry is None:
+                return b""
+            mk, expires = entry
+            if expires < time.monotonic():
+                del self.keys[key]
+                return b""
+            self.keys.move_to_end(key)
+            return mk
+
+    def put(self, key: str, mk: bytes):
+        with self.lock:
+            now = time.monotonic()
+            for k in [k for k, (_, expires) in self.keys.items() if expires < now]:
+                del self.keys[k]
+            self.keys[key] = (mk, now + self.ttl)
+            self.keys.move_to_end(key)
+            while len(self.keys) > self.max_keys:
+                self.keys.popitem(last=False)
+
+    def handle(self, request: dict) -> dict:
+        key = str(request["salt"])
+        if request["op"] == "put":
+            self.put(key, bytes.fromhex(request["mk"]))
+            return {"ok": True}
+        mk = self.get(key)
+        return {"mk": mk.hex()} if mk else {}
+
+    def serve(self, sock_path: str):
+        import socketserver
+        agent = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                # one JSON request per line, one JSON reply per line
+                for line in self.rfile:
+                    try:
+                        reply = agent.handle(json.loads(line))
+                    except (ValueError, KeyError, TypeError):
+                        reply = {"error": "bad request"}
+                    self.wfile.write(json.dumps(reply).encode("utf-8") + b"\n")
+
+        # the socket is only usable by its owner
+        umask = os.umask(0o177)
+        try:
+            server = socketserver.ThreadingUnixStreamServer(sock_path, Handler)
+        finally:
+            os.umask(umask)
+        with server:
+            try:
+                server.serve_forever()
+            finally:
+                Path(sock_path).unlink(missing_ok=True)
+
+def run_agent(sock_path: str, ttl: float, max_keys: int):
+    '''
+    Run the key agent in the foreground, printing how clients find it
+    '''
+    import tempfile
+    sock_dir = ""
+    if not sock_path:
+        sock_dir = tempfile.mkdtemp(prefix="fenc-agent-")
+        sock_path = str(Path(sock_dir) / "agent.sock")
+    print(f"FENC_AGENT_SOCK={sock_path}; export FENC_AGENT_SOCK;", flush=True)
+    # shut down cleanly, removing the socket, on kill as well as ^C
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    try:
+        KeyAgent(ttl, max_keys).serve(sock_path)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if sock_dir:
+            os.rmdir(sock_dir)
+
+def agent_request(request: dict) -> dict:
+    '''
+    Send one request to the agent at $FENC_AGENT_SOCK.
+    Returns {} when no agent is configured or it cannot be reached.
+    '''
+    sock_path = os.environ.get("FENC_AGENT_SOCK")
+    if not sock_path:
+        return {}
+    import socket
+    try:
+        with timed("agent"), socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+            s.settimeout(AGENT_TIMEOUT)
+            s.connect(sock_path)
+            s.sendall(json.dumps(request).encode("utf-8") + b"\n")
+            with s.makefile("rb") as f:
+                reply = f.readline()
+        return json.loads(reply) if reply else {}
+    except (OSError, ValueError):
+        return {}
+
+def agent_get(salt: bytes) -> bytes:
+    reply = agent_request({"op": "get", "salt": salt.hex()})
+    try:
+        mk = bytes.fromhex(reply.get("mk", ""))
+    except (ValueError, TypeError):
+        return b""
+    return mk if len(mk) == 32 else b""
+
+def agent_put(salt: bytes, mk: bytes) -> bool:
+    return bool(agent_request({"op": "put", "salt": salt.hex(), "mk": mk.hex()}).get("ok"))
+
+def agent_add(fname: str, pwd: bytes):
+    '''
+    Hand the master key of `fname` to the key agent, once `pwd` is checked
+    against its validator. This is the only way keys reach the agent, so
+    it only serves files the user added on purpose.
+    '''
+    md_file = get_metadata_file(Path(fname))
+    if not md_file.exists():
+        exit_error(f"No metadata file for: {fname}")
+    md = read_metadata(str(md_file), False, terms=False)
+    salt = bytes.fromhex(str(md["salt"]))
+    # derived here even if the agent has it, so a wrong password is refused
+    ctx = KeyContext(pwd, salt)
+    if ctx.keys["val"].hex() != md["validator"]:
+        exit_error(f"{fname}: Password does not match.")
+    if not agent_put(salt, ctx.mk):
+        exit_error("Error: no key agent at $FENC_AGENT_SOCK.")
+    print(f"Added {Path(fname).name} to the key agent.", file=sys.stderr)
+
+##################
+### Statistics ###
+##################
+
+# called with each file's stats dict once that file is done; see add_stats_hook
+stats_hooks: "list[Callable[[dict], None]]" = []
+
+class FileStats:
+    '''
+    Wall time, bytes and calls per phase of one file operation
+    '''
+    def __init__(self, fname: str, op: str):
+        self.fname = fname
+        self.op = op
+        self.phases: "dict[str, list]" = {}
+        self.start = time.perf_counter()
+        self.lock = threading.Lock()
+
+    def add(self, phase: str, seconds: float, nbytes: int):
+        # cipher threads add to the same phases concurrently
+        with self.lock:
+            totals = self.phases.setdefault(phase, [0.0, 0, 0])
+            totals[0] += seconds
+            totals[1] += nbytes
+            totals[2] += 1
+
+    def as_dict(self) -> dict:
+        return {
+            "file": self.fname,
+            "op": self.op,
+            "seconds": time.perf_counter() - self.start,
+            "phases": {p: {"seconds": t, "bytes": b, "calls": c} for p, (t, b, c) in self.phases.items()},
+        }
+
+class Timer:
+    '''
+    Adds the time spent in its `with` block to a phase of `stats`.
+    `nbytes` may be set inside the block once the byte count is known.
+    '''
+    __slots__ = ("stats", "phase", "nbytes", "start")
+
+    def __init__(self, stats: Union[FileStats, None], phase: str, nbytes: int):
+        self.stats = stats
+        self.phase = phase
+        self.nbytes = nbytes
+
+    def __enter__(self) -> "Timer":
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        if self.stats:
+            self.stats.add(self.phase, time.perf_counter() - self.start, self.nbytes)
+
+# stats of the file being processed; None while stats are off
+file_stats: Union[FileStats, None] = None
+NO_TIMER = Timer(None, "", 0)
+
+def timed(phase: str, nbytes: int = 0) -> Timer:
+    '''
+    Time `phase` of the current file; a shared no-op when stats are off
+    '''
+    if file_stats is None:
+        return NO_TIMER
+    return Timer(file_stats, phase, nbytes)
+
+@contextmanager
+def tracking(fname: str, op: str):
+    '''
+    Collect the stats of one file operation while any hook is registered
+    '''
+    global file_stats
+    if not stats_hooks or file_stats is not None:
+        yield
+        return
+    file_stats = FileStats(fname, op)
+    try:
+        yield
+    finally:
+        stats, file_stats = file_stats, None
+        report_stats(stats.as_dict())
+
+def add_stats_hook(hook: Callable[[dict], None]):
+    '''
+    Call `hook` with the phase timings of every file encrypted, decrypted
+    or searched from now on, e.g.
+    {"file": "a.txt", "op": "encrypt", "seconds": 0.12,
+     "phases": {"kdf": {"seconds": 0.07, "bytes": 0, "calls": 1}, ...}}
+    '''
+    stats_hooks.append(hook)
+
+def report_stats(stats: dict):
+    for hook in stats_hooks:
+        hook(stats)
+
+def collect_stats(enabled: bool, fn: Callable, *args) -> tuple:
+    '''
+    Run `fn(*args)` keeping the stats it produces instead of reporting them,
+    so a parent can report stats gathered in a worker process.
+    Returns (result, list of stats dicts).
+    '''
+    global stats_hooks
+    collected = []
+    saved, stats_hooks = stats_hooks, [collected.append] if enabled else []
+    try:
+        result = fn(*args)
+    finally:
+        stats_hooks = saved
+    return result, collected
+
+def summarize_stats(files: "list[dict]") -> dict:
+    '''
+    Per-file stats plus their totals, for --stats
+    '''
+    total = {"files": len(files), "seconds": 0.0, "phases": {}}
+    for stats in files:
+        total["seconds"] += stats["seconds"]
+        for phase, p in stats["phases"].items():
+            t = total["phases"].setdefault(phase, {"seconds": 0.0, "bytes": 0, "calls": 0})
+            for k in t:
+                t[k] += p[k]
+    return {"files": files, "total": total}
+
 ###############
 ### Helpers ###
 ###############
 
+class TermIndex:
+    '''
+    Sorted, fixed-width array of raw term macs, searched by bisection.
+    Backed by an mmap of the binary metadata's term table, or of
+    `.fenc-terms.<name>` for JSON metadata, when there is one.
+    '''
+    WIDTH = 32
+
+    def __init__(self, buf: Union[bytes, mmap], start: int = 0, count: int = -1):
+        self.buf = buf
+        self.start = start
+        self.count = (len(buf) - start) // self.WIDTH if count < 0 else count
+
+    @classmethod
+    def load(cls, fname: str, md_dict: dict) -> "TermIndex":
+        if "terms_offset" in md_dict:
+            index_path = get_metadata_file(Path(fname))
+            start, count = md_dict["terms_offset"], md_dict["terms_count"]
+        else:
+            index_path = get_metadata_file(Path(fname), ".fenc-terms.")
+            start, count = 0, -1
+        if count and index_path.exists() and index_path.stat().st_size > start:
+            with index_path.open("rb") as f:
+                return cls(mmap(f.fileno(), 0, access=ACCESS_READ), start, count)
+        # metadata written without an index; its hex terms are already sorted
+        return cls(b"".join(sorted(bytes.fromhex(t) for t in md_dict.get("terms", []))))
+
+    def record(self, i: int) -> bytes:
+        at = self.start + i * self.WIDTH
+        return self.buf[at:at + self.WIDTH]
+
+    def __contains__(self, mac: bytes) -> bool:
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.record(mid) < mac:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo < self.count and self.record(lo) == mac
+
+    def __enter__(self) -> "TermIndex":
+        return self
+
+    def __exit__(self, *exc):
+        if isinstance(self.buf, mmap):
+            self.buf.close()
+
+class MacTable:
+    '''
+    The chunk macs of a chunked file in chunk order, read one entry at a
+    time from an mmap of the binary metadata's raw chunk mac table, so a
+    range read only touches the entries it needs. Indexes and iterates
+    like the hex list JSON metadata keeps.
+    '''
+    WIDTH = 32
+
+    def __init__(self, buf: Union[bytes, mmap], start: int, count: int):
+        self.buf = buf
+        self.start = start
+        self.count = count
+
+    def raw(self) -> bytes:
+        return self.buf[self.start:self.start + self.count * self.WIDTH]
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __getitem__(self, i: int) -> str:
+        if not 0 <= i < self.count:
+            raise IndexError(i)
+        at = self.start + i * self.WIDTH
+        return self.buf[at:at + self.WIDTH].hex()
+
+    def __iter__(self):
+        return (self[i] for i in range(self.count))
+
+class Catalog:
+    '''
+    SQLite table of the encrypted files in one directory, with the salt,
+    validator, MAC and term table location of each, so search can list
+    and check them without a directory scan or a metadata parse. Encrypt
+    and decrypt keep it current; a new catalog is filled from the
+    metadata files already in the directory, and one that lists nothing
+    is removed.
+    '''
+    VERSION = 3
+    # a directory modified this recently may change again within the same
+    # mtime tick, so its listing is not trusted yet (as git does for racy files)
+    RACY_NS = 2_000_000_000
+
+    def __init__(self, directory: Path):
+        import sqlite3
+        self.dir = directory
+        self.db = sqlite3.connect(str(directory / CATALOG_NAME), timeout=60, isolation_level=None)
+        try:
+            # the journal is kept between transactions (WAL files come and go
+            # with each connection), so using the catalog leaves the
+            # directory's mtime alone
+            self.db.execute("PRAGMA journal_mode=PERSIST")
+            if self.version() != self.VERSION:
+                self.__fill()
+        except BaseException:
+            self.db.close()
+            raise
+
+    def version(self) -> int:
+        return self.db.execute("PRAGMA user_version").fetchone()[0]
+
+    def __fill(self):
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            # another process may have filled it while this one waited
+            if self.version() != self.VERSION:
+                self.db.execute("DROP TABLE IF EXISTS files")
+                self.db.execute("DROP TABLE IF EXISTS state")
+                self.db.execute("CREATE TABLE files (name TEXT PRIMARY KEY, "
+                                "salt TEXT, validator TEXT, mac TEXT, terms_offset INTEGER, "
+                                "terms_count INTEGER, inline INTEGER, mtime_ns INTEGER, size INTEGER)")
+                # the directory mtime the files were last checked against
+                self.db.execute("CREATE TABLE state (key TEXT PRIMARY KEY, value)")
+                for md in self.dir.glob(".fenc-meta.*"):
+                    try:
+                        self.load(md.name[len(".fenc-meta."):])
+                    except (OSError, ValueError, struct.error):
+                        error_msg(f"Error: unreadable metadata {md.name}.")
+                self.db.execute(f"PRAGMA user_version = {self.VERSION}")
+            self.db.execute("COMMIT")
+        except BaseException:
+            self.db.execute("ROLLBACK")
+            raise
+
+    def load(self, name: str):
+        '''
+        Add or replace `name` from its metadata file
+        '''
+        md_dict = read_metadata(str(self.dir / f".fenc-meta.{name}"), False, terms=False)
+        # JSON metadata written without a `.fenc-terms.` index
+        inline = ("terms_offset" not in md_dict and bool(md_dict.get("terms"))
+                  and not (self.dir / f".fenc-terms.{name}").exists())
+        self.put(name, md_dict, inline)
+
+    def put(self, name: str, md: dict, inline: bool = False):
+        '''
+        Add or replace `name`, given its metadata (with "terms_offset" and
+        "terms_count" for binary metadata), once its metadata file is
+        written. `inline` marks JSON metadata that holds its only copy of
+        the terms.
+        '''
+        st = (self.dir / f".fenc-meta.{name}").stat()
+        self.db.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                        (name, md["salt"], md["validator"], md["mac"], md.get("terms_offset"),
+                         md.get("terms_count"), int(inline), st.st_mtime_ns, st.st_size))
+
+    def drop(self, name: str):
+        '''
+        Remove `name`, and have the next `listing` check the directory, in
+        case the file stays encrypted without its row
+        '''
+        self.db.execute("DELETE FROM files WHERE name = ?", (name,))
+        self.db.execute("DELETE FROM state WHERE key = 'dir_mtime_ns'")
+
+    def entries(self):
+        '''
+        Yield (file name, entry) in name order, the entry shaped like
+        `read_metadata(..., terms=False)` for what search needs
+        '''
+        for name, entry, _ in self.__rows():
+            yield name, entry
+
+    def __rows(self, name: "Union[str, None]" = None):
+        if name is None:
+            rows = self.db.execute("SELECT * FROM files ORDER BY name")
+        else:
+            rows = self.db.execute("SELECT * FROM files WHERE name = ?", (name,))
+        for name, salt, val, mac, terms_offset, terms_count, inline, mtime_ns, size in rows:
+            entry = {"salt": salt, "validator": val, "mac": mac}
+            if terms_offset is not None:
+                entry["terms_offset"] = terms_offset
+                entry["terms_count"] = terms_count
+            if inline:
+                entry["inline"] = True
+            yield name, entry, (mtime_ns, size)
+
+    def listing(self) -> "dict[str, dict]":
+        '''
+        The entries of the encrypted files in the directory. While the
+        directory is unchanged since it was last checked they come from the
+        catalog alone; otherwise its metadata files are listed and checked
+        with `current`, and the directory's mtime (read first, so a change
+        during the check is seen next time) is recorded.
+        '''
+        mtime_ns = self.dir.stat().st_mtime_ns
+        row = self.db.execute("SELECT value FROM state WHERE key = 'dir_mtime_ns'").fetchone()
+        if row and row[0] == mtime_ns:
+            return dict(self.entries())
+        names = sorted(md.name[len(".fenc-meta."):] for md in self.dir.glob(".fenc-meta.*"))
+        entries = self.current(names)
+        if time.time_ns() - mtime_ns > self.RACY_NS:
+            self.db.execute("INSERT OR REPLACE INTO state VALUES ('dir_mtime_ns', ?)", (mtime_ns,))
+        return entries
+
+    def current(self, names: "list[str]") -> "dict[str, dict]":
+        '''
+        The entries of `names`, the files whose metadata is in the directory
+        now. Rows whose metadata has gone are dropped, and files that are
+        missing or whose metadata changed since their row was written are
+        read again; those that cannot be read get no entry.
+        '''
+        rows = {name: (entry, stamp) for name, entry, stamp in self.__rows()}
+        for name in rows.keys() - set(names):
+            self.drop(name)
+        entries = {}
+        for name in names:
+            entry, stamp = rows.get(name, (None, None))
+            try:
+                st = (self.dir / f".fenc-meta.{name}").stat()
+                if stamp != (st.st_mtime_ns, st.st_size):
+                    self.load(name)
+                    _, entry, _ = next(self.__rows(name))
+            except (OSError, ValueError, struct.error):
+                continue
+            entries[name] = entry
+        return entries
+
+    @classmethod
+    def discard(cls, directory: Path, name: str):
+        '''
+        Drop `name` from `directory`'s catalog, if it has one, removing the
+        catalog once it lists nothing. Losing a catalog is always safe:
+        search then reads the metadata files, and encrypt fills a new one.
+        '''
+        if not (directory / CATALOG_NAME).exists():
+            return
+        with cls(directory) as catalog:
+            catalog.drop(name)
+            empty = catalog.db.execute("SELECT 1 FROM files LIMIT 1").fetchone() is None
+        if empty:
+            for suffix in ("", "-journal", "-wal", "-shm"):
+                (directory / f"{CATALOG_NAME}{suffix}").unlink(missing_ok=True)
+
+    def __enter__(self) -> "Catalog":
+        return self
+
+    def __exit__(self, *exc):
+        self.db.close()
+
 #TODO: Verify Message or Exit
 
-class Noop:
-    def __init__(self, pwd: bytes):
+class KeyContext:
+    '''
+    Master key and key schedule for one (password, salt) pair
+    '''
+    def __init__(self, pwd: bytes, salt: bytes, mk: bytes = b""):
         self.pwd = pwd
+        self.salt = salt
+        if not mk:
+            with timed("kdf"):
+                mk = pbkdf2_hmac('sha256', pwd, salt, 250_000)
+        self.mk = mk
         self.keys = {}
+        with timed("key_sched"):
+            key_sched(self, self.mk)
+
+# every KeyContext derived by this process, by (password, salt)
+key_contexts: "dict[tuple[bytes, bytes], KeyContext]" = {}
+
+def key_context(pwd: bytes, salt: bytes) -> KeyContext:
+    '''
+    Run PBKDF2 for (pwd, salt) at most once per invocation, and not at
+    all if the key agent holds the master key
+    '''
+    ctx = key_contexts.get((pwd, salt))
+    if ctx is None:
+        ctx = key_contexts[(pwd, salt)] = new_key_context(pwd, salt)
+    return ctx
+
+def new_key_context(pwd: bytes, salt: bytes) -> KeyContext:
+    '''
+    A KeyContext for (pwd, salt), with the master key from the key agent
+    if it holds one, that is not kept by this process. The library API
+    uses these, so a long-lived caller does not accumulate passwords and
+    master keys. Derived keys are not given to the agent (see `agent_add`).
+    '''
+    return KeyContext(pwd, salt, agent_get(salt))
 
 def error_msg(error):
 	print(error, file=sys.stderr)
@@ -201,6 +1048,18 @@ def hash_mac(key: bytes, text: bytes) -> str:
     h.update(text)
     return h.hexdigest()
 
+def mac_terms(key: bytes, terms) -> "list[str]":
+    '''
+    Hex HMAC of each term, reusing one keyed HMAC state for all of them
+    '''
+    base = hmac.new(key, digestmod="sha256")
+    macs = []
+    for t in terms:
+        h = base.copy()
+        h.update(t.encode("utf-8"))
+        macs.append(h.hexdigest())
+    return macs
+
 def get_pwd(fname: str="") -> bytes:
     if sys.stdin.isatty():
         if not fname:
@@ -214,40 +1073,18 @@ def get_pwd(fname: str="") -> bytes:
     return pwd
 
 def pwd_authen(pwd: bytes, md: str) -> bool:
-    md_dict = json.load(open(md, "r"))
+    md_dict = read_metadata(md, False, terms=False)
     salt = md_dict["salt"]
     return md_dict["validator"] == validator(pwd, salt)
 
-def mac_authen(pwd: bytes, md: str, fname: str) -> bool: 
-    md_dict = json.load(open(md, "r"))
-    noop = Noop(pwd)
-    key_sched(noop, masterkey(noop, bytes.fromhex(md_dict["salt"])))
-    mac_key = noop.keys["mac"]
-    with open(fname, "r+b") as f:
-        ct = f.read()
-        f.close()
-    mac = hash_mac(mac_key, ct)
-    return md_dict["mac"] == mac
-
 def salt_gen() -> bytes:
     return token_bytes(16)
 
-def masterkey(task: Union[Encrypt, Decrypt, Search, Noop], salt: bytes = b"") -> bytes:
-    if not salt:
-        salt = salt_gen()
-    mk = pbkdf2_hmac('sha256', task.pwd, salt, 250_000)
-    if type(task) == Encrypt:
-        task.metadata["salt"] = salt
-    return mk
-
 def validator(pwd: bytes, salt: str) -> str:
-    mk = pbkdf2_hmac('sha256', pwd, bytes.fromhex(salt), 250_000)
-    left, right = mk[:16], mk[-16:]
-    aes = AES.new(left, AES.MODE_ECB)
-    val = aes.encrypt(right)
-    return val.hex()
+    return key_context(pwd, bytes.fromhex(salt)).keys["val"].hex()
 
-def key_sched(task: Union[Encrypt, Decrypt, Search, Noop], mk: bytes):
+def key_sched(task: Union[Encrypt, Decrypt, Search, KeyContext], mk: bytes):
+    from Crypto.Cipher import AES
     left, right = mk[:16], mk[-16:]
     aes = AES.new(left, AES.MODE_ECB)
     val = aes.encrypt(right)
@@ -273,60 +1110,598 @@ def ctr(aes, a_byte: bytes, b: int) -> bytes:
         a_byte[i] = byte_index
     return aes.encrypt(bytes(a_byte))
 
-def get_metadata_file(fpath: Path) -> Path:
+def get_metadata_file(fpath: Path, prefix: str = ".fenc-meta.") -> Path:
     if fpath.parent.name == "examples":
         fpath = fpath.parent.parent / fpath.name
-    return fpath.parent / f".fenc-meta.{fpath.name}"
+    return fpath.parent / f"{prefix}{fpath.name}"
+
+def is_fenc_file(name: str) -> bool:
+    '''
+    Whether `name` is one of fencrypt's own metadata, index or staged files
+    '''
+    return name.startswith((".fenc-meta.", ".fenc-terms.", CATALOG_NAME)) or name.endswith(".fenc-tmp")
+
+def walk_tree(root: str, onerror: "Union[Callable[[OSError], None], None]" = None):
+    '''
+    Lazily yield the paths of the regular files under `root`, depth first
+    in name order, without following symlinks. Directories that cannot be
+    listed are passed over, after calling `onerror` with the OSError
+    (by default it is printed).
+    '''
+    stack = [root]
+    while stack:
+        d = stack.pop()
+        try:
+            with os.scandir(d) as it:
+                entries = sorted(it, key=lambda e: e.name)
+        except OSError as e:
+            if onerror:
+                onerror(e)
+            else:
+                error_msg(f"Error: {e}")
+            continue
+        for e in entries:
+            if e.is_file(follow_symlinks=False):
+                yield e.path
+        stack.extend(e.path for e in reversed(entries) if e.is_dir(follow_symlinks=False))
+
+def find_metadata(recursive: bool = False):
+    '''
+    Yield (metadata file, catalog entry) for the encrypted files in the
+    current directory, or (metadata file, None) for those under it when
+    `recursive`. The current directory's catalog, if it has one, lists
+    the files (see `Catalog.listing`); search never creates a catalog.
+    '''
+    if not recursive:
+        import sqlite3
+        if (Path.cwd() / CATALOG_NAME).exists():
+            try:
+                with Catalog(Path.cwd()) as catalog:
+                    entries = catalog.listing()
+                yield from ((f".fenc-meta.{name}", entry) for name, entry in sorted(entries.items()))
+                return
+            except (sqlite3.Error, OSError):
+                pass
+        names = sorted(md.name[len(".fenc-meta."):] for md in Path.cwd().glob(".fenc-meta.*"))
+        yield from ((f".fenc-meta.{name}", None) for name in names)
+        return
+    for fname in walk_tree("."):
+        if Path(fname).name.startswith(".fenc-meta."):
+            yield os.path.relpath(fname), None
 
-def read_metadata(fname: str, b: bool = True) -> "dict[str, Union[str, list[str]]]":
+def read_metadata(fname: str, b: bool = True, terms: bool = True) -> "dict[str, Union[str, list[str]]]":
+    '''
+    Load JSON or binary metadata. For binary metadata `terms=False` reads
+    only the header, leaving "terms_offset"/"terms_count" to locate the
+    term table, and the chunk macs of a chunked file are a `MacTable`;
+    JSON metadata is always loaded whole.
+    '''
     if b:
         f = get_metadata_file(Path(fname))
     else:
         f = Path(fname)
-    with f.open('r', encoding="utf-8") as f:
-        contents = json.load(f)
+    with timed("metadata_read"), f.open('rb') as f:
+        head = f.read(META_HEADER.size)
+        if not head.startswith(META_MAGIC):
+            contents = json.loads((head + f.read()).decode("utf-8"))
+            f.close()
+            return contents
+        _, version, salt, val, mac, ext_len, count = META_HEADER.unpack(head)
+        if version != META_VERSION:
+            exit_error(f"Error: unsupported metadata version {version}.")
+        contents = {"salt": salt.hex(), "validator": val.hex(), "mac": mac.hex()}
+        if ext_len:
+            contents.update(json.loads(f.read(ext_len).decode("utf-8")))
+        contents["terms_offset"] = META_HEADER.size + ext_len
+        contents["terms_count"] = count
+        if "chunk_count" in contents:
+            chunks_offset = contents["terms_offset"] + count * TermIndex.WIDTH
+            contents["chunk_macs"] = MacTable(mmap(f.fileno(), 0, access=ACCESS_READ),
+                                              chunks_offset, contents.pop("chunk_count"))
+        if terms:
+            table = f.read(count * TermIndex.WIDTH)
+            contents["terms"] = [table[i:i + TermIndex.WIDTH].hex()
+                                 for i in range(0, len(table), TermIndex.WIDTH)]
         f.close()
     return contents
 
-def gen_keys(task: Union[Decrypt, Search], fname: str="") -> "dict[str, bytes]":
-    if type(task) == Decrypt:
-        task.metadata = read_metadata(task.path.name)
-    if type(task) == Search:
-        task.metadata = read_metadata(fname)
-    mk = masterkey(task, bytes.fromhex(str(task.metadata["salt"])))
-    key_sched(task, mk)
-    return task.keys
+def write_binary_metadata(path: Path, md: dict) -> int:
+    '''
+    Write hex-encoded metadata `md` in the binary format (see META_HEADER).
+    Returns the offset of the term table.
+    '''
+    ext = {k: v for k, v in md.items() if k not in ("salt", "validator", "mac", "terms", "chunk_macs")}
+    chunk_macs = md.get("chunk_macs", [])
+    if chunk_macs:
+        ext["chunk_count"] = len(chunk_macs)
+    ext_bytes = json.dumps(ext).encode("utf-8") if ext else b""
+    header = META_HEADER.pack(META_MAGIC, META_VERSION, bytes.fromhex(md["salt"]),
+                              bytes.fromhex(md["validator"]), bytes.fromhex(md["mac"]),
+                              len(ext_bytes), len(md["terms"]))
+    with path.open("xb") as f:
+        f.write(header)
+        f.write(ext_bytes)
+        f.write(b"".join(bytes.fromhex(t) for t in md["terms"]))
+        f.write(b"".join(bytes.fromhex(m) for m in chunk_macs))
+        f.close()
+    return META_HEADER.size + len(ext_bytes)
 
 def aes_rd(key: bytes, left: bytes, right: bytes) -> "list[bytes]":
-    numbytes = len(right)
-    aes = AES.new(key, AES.MODE_ECB)
-    keystream = b""
-    count = 0
-    while len(keystream) < numbytes:
-        keystream += ctr(aes, left, count)
-        count += 1
-    return [left, xor_byte_func(keystream, right)]
+    return [left, xor_byte_func(keystream(key, left, 0, len(right)), right)]
+
+def keystream(key: bytes, left: bytes, offset: int, numbytes: int) -> bytes:
+    '''
+    Bytes [offset, offset + numbytes) of the `aes_rd` keystream for `left`.
+    Block i is `ctr(aes, left, i)`; runs of counters that do not wrap past
+    2**128 are encrypted in one AES-CTR call, the rest fall back to `ctr`.
+    '''
+    from Crypto.Cipher import AES
+    count, skip = divmod(offset, 16)
+    nblocks = -(-(skip + numbytes) // 16)
+    start = int.from_bytes(left, "big") + count
+    # counters below 2**128 are plain big-endian additions
+    fast = max(0, min(nblocks, (1 << 128) - start))
+    ks = b""
+    if fast:
+        aes = AES.new(key, AES.MODE_CTR, nonce=b"", initial_value=start)
+        ks = aes.encrypt(bytes(16 * fast))
+    if fast < nblocks:
+        aes = AES.new(key, AES.MODE_ECB)
+        ks += b"".join(ctr(aes, left, i) for i in range(count + fast, count + nblocks))
+    return ks[skip:skip + numbytes]
+
+@contextmanager
+def mapped(fpath: Path):
+    '''
+    The whole of `fpath` as one read-only buffer: an mmap, or b"" when the
+    file is empty (an empty file cannot be mapped)
+    '''
+    with fpath.open("rb") as f:
+        if not os.fstat(f.fileno()).st_size:
+            yield b""
+            return
+        buf = mmap(f.fileno(), 0, access=ACCESS_READ)
+        try:
+            yield buf
+        finally:
+            buf.close()
+
+@contextmanager
+def staged_file(fpath: Path):
+    '''
+    A temp file next to `fpath` for its new contents, opened for reading
+    too so the encrypt MAC pass can read it back. When the block ends
+    it is synced and given `fpath`'s mode, ready to `os.replace` `fpath`
+    atomically; on error it is removed and `fpath` is left as it was.
+    '''
+    import tempfile
+    out = tempfile.NamedTemporaryFile("w+b", dir=fpath.parent, prefix=f".{fpath.name}.",
+                                      suffix=".fenc-tmp", delete=False)
+    try:
+        with out:
+            yield out
+            out.flush()
+            os.fsync(out.fileno())
+        shutil.copymode(fpath, out.name)
+    except BaseException:
+        os.unlink(out.name)
+        raise
+
+def commit_decrypted(fpath: Path, staged: Path):
+    '''
+    Replace the ciphertext `fpath` with its staged plaintext and drop its metadata
+    '''
+    # the row is dropped before the plaintext lands, so the catalog never
+    # lists a file that is not encrypted; a file left encrypted without
+    # a row is read from its metadata by the next search
+    try:
+        Catalog.discard(get_metadata_file(fpath).parent, fpath.name)
+    except BaseException:
+        staged.unlink()
+        raise
+    os.replace(staged, fpath)
+    Path.unlink(get_metadata_file(fpath))
+    get_metadata_file(fpath, ".fenc-terms.").unlink(missing_ok=True)
+    print(f"Success! {fpath.name} is decrypted.", file=sys.stderr)
+
+@contextmanager
+def compressed(buf: Union[bytes, mmap], compression: str, fpath: Union[Path, None] = None):
+    '''
+    `buf` compressed with `compression`, spooled to a temp file next to
+    `fpath` and mapped, or held in memory without `fpath`. Yields `buf`
+    itself when `compression` is "" or would not make it smaller.
+    '''
+    if not compression:
+        yield buf
+        return
+    import tempfile
+    with tempfile.TemporaryFile(dir=fpath.parent) if fpath else io.BytesIO() as tmp:
+        z = zlib.compressobj()
+        for _, chunk in read_chunks(buf, 0):
+            with timed("compress", len(chunk)):
+                tmp.write(z.compress(chunk))
+        tmp.write(z.flush())
+        # too short to encrypt, or no gain
+        if not 32 <= tmp.tell() < len(buf):
+            yield buf
+        elif not fpath:
+            yield tmp.getvalue()
+        else:
+            tmp.flush()
+            packed = mmap(tmp.fileno(), 0, access=ACCESS_READ)
+            try:
+                yield packed
+            finally:
+                packed.close()
+
+class Inflater:
+    '''
+    Write-only file that decompresses what is written to it into `f`.
+    Writes must be in order, as the last decrypt pass makes them;
+    `finish` checks the compressed stream was complete.
+    '''
+    def __init__(self, f):
+        self.f = f
+        self.z = zlib.decompressobj()
+        self.pos = 0
+
+    def seek(self, offset: int):
+        if offset != self.pos:
+            raise ValueError("compressed plaintext must be written in order")
+
+    def write(self, data: bytes):
+        self.pos += len(data)
+        with timed("decompress", len(data)):
+            # inflate a chunk at a time so a small input cannot balloon in memory
+            out = self.z.decompress(data, CHUNK_SIZE)
+            while True:
+                self.f.write(out)
+                if not self.z.unconsumed_tail:
+                    break
+                out = self.z.decompress(self.z.unconsumed_tail, CHUNK_SIZE)
+
+    def finish(self):
+        self.f.write(self.z.flush())
+        if not self.z.eof:
+            raise ValueError("compressed plaintext is truncated")
+
+def read_chunks(buf: Union[bytes, mmap], start: int):
+    '''
+    Yield (offset, chunk) pairs from `start` to the end of `buf`
+    '''
+    for offset in range(start, len(buf), CHUNK_SIZE):
+        with timed("file_read") as t:
+            chunk = buf[offset:offset + CHUNK_SIZE]
+            t.nbytes = len(chunk)
+        yield offset, chunk
+
+def read_back(f, start: int):
+    '''
+    Yield the chunks of the open file `f` from `start` to its end
+    '''
+    f.flush()
+    f.seek(start)
+    while True:
+        with timed("file_read") as t:
+            chunk = f.read(CHUNK_SIZE)
+            t.nbytes = len(chunk)
+        if not chunk:
+            return
+        yield chunk
+
+def write_at(f, offset: int, data: bytes):
+    with timed("file_write", len(data)):
+        f.seek(offset)
+        f.write(data)
+
+def ctr_xor(key: bytes, left: bytes, offset: int, data: bytes) -> bytes:
+    '''
+    `data` XOR the `aes_rd` keystream, starting `offset` bytes into it.
+    Unless the counter wraps past 2**128, AES-CTR does the XOR itself in
+    one native call, which also lets cipher threads run it in parallel.
+    '''
+    from Crypto.Cipher import AES
+    with timed("aes_rounds", len(data)):
+        count, skip = divmod(offset, 16)
+        start = int.from_bytes(left, "big") + count
+        if start + -(-(skip + len(data)) // 16) > 1 << 128:
+            return xor_byte_func(data, keystream(key, left, offset, len(data)))
+        aes = AES.new(key, AES.MODE_CTR, nonce=b"", initial_value=start)
+        if skip:
+            aes.encrypt(bytes(skip))
+        return aes.encrypt(data)
+
+def set_cipher_threads(n: int):
+    '''
+    Run the keystream XORs of each file on `n` threads (1: inline)
+    '''
+    global cipher_threads, cipher_pool
+    cipher_threads = max(1, n)
+    # a pool inherited from a forked parent has no threads behind it
+    cipher_pool = None
+
+def pipelined(fn: Callable, items):
+    '''
+    Yield fn(item) for each of `items`, in order. With cipher threads, up
+    to that many items are worked on ahead while the caller hashes and
+    writes the earlier results.
+    '''
+    global cipher_pool
+    if cipher_threads <= 1:
+        yield from map(fn, items)
+        return
+    if cipher_pool is None:
+        from concurrent.futures import ThreadPoolExecutor
+        cipher_pool = ThreadPoolExecutor(cipher_threads, thread_name_prefix="fenc-cipher")
+    ahead = deque()
+    for item in items:
+        ahead.append(cipher_pool.submit(fn, item))
+        if len(ahead) > cipher_threads:
+            yield ahead.popleft().result()
+    while ahead:
+        yield ahead.popleft().result()
+
+def hmac_update(h, data: bytes, phase: str = "hmac_rounds"):
+    with timed(phase, len(data)):
+        h.update(data)
+
+def feistel_encrypt_stream(keys: "dict[str, bytes]", src: Union[bytes, mmap], dst) -> str:
+    '''
+    Encrypt the buffer `src` into the empty file `dst`, one chunk at a time.
+    Produces the same bytes as the four whole-file rounds and returns the
+    hex HMAC of the ciphertext. `src` is read twice, and `dst` (which must
+    be readable) is written once and read back once for the MAC.
+    '''
+    key_1, key_2, key_3, key_4 = keys["feistel"]
+    left0 = bytes(src[:16])
+    # pass 1: right1 = right0 ^ ks1, hashed into left2
+    def right1_of(chunk: "tuple[int, bytes]") -> bytes:
+        off, right0 = chunk
+        return ctr_xor(key_1, left0, off - 16, right0)
+
+    h2 = hmac.new(key_2, digestmod="sha256")
+    for chunk in pipelined(right1_of, read_chunks(src, 16)):
+        hmac_update(h2, chunk)
+    left2 = xor_byte_func(h2.digest(), left0)
+
+    def right3_of(chunk: "tuple[int, bytes]") -> "tuple[int, bytes]":
+        off = chunk[0]
+        return off, ctr_xor(key_3, left2, off - 16, right1_of(chunk))
+
+    # pass 2: right3 = right1 ^ ks3, written out and hashed into left4
+    h4 = hmac.new(key_4, digestmod="sha256")
+    write_at(dst, 0, bytes(len(left0)))
+    for off, right3 in pipelined(right3_of, read_chunks(src, 16)):
+        hmac_update(h4, right3)
+        write_at(dst, off, right3)
+    left4 = xor_byte_func(h4.digest(), left2)
+    write_at(dst, 0, left4)
+    # pass 3: mac over the finished ciphertext, read back from dst rather
+    # than running both ctr rounds over src again
+    mac = hmac.new(keys["mac"], digestmod="sha256")
+    hmac_update(mac, left4, "mac")
+    for right3 in read_back(dst, len(left4)):
+        hmac_update(mac, right3, "mac")
+    return mac.hexdigest()
+
+def feistel_decrypt_stream(keys: "dict[str, bytes]", src: Union[bytes, mmap], dst,
+                           mac: str = "") -> bool:
+    '''
+    Decrypt the buffer `src` into the empty file `dst`, one chunk at a time.
+    If `mac` is given it is checked on the first pass, and nothing is
+    written (and False returned) when it does not match.
+    '''
+    key_1, key_2, key_3, key_4 = keys["feistel"]
+    left4 = bytes(src[:16])
+    # pass 1: left3 = left4 ^ hmac(right3), alongside the ciphertext mac
+    h4 = hmac.new(key_4, digestmod="sha256")
+    check = hmac.new(keys["mac"], left4, digestmod="sha256") if mac else None
+    for _, right3 in read_chunks(src, 16):
+        hmac_update(h4, right3)
+        if check:
+            hmac_update(check, right3, "mac_check")
+    if check and not hmac.compare_digest(check.hexdigest(), mac):
+        return False
+    left3 = xor_byte_func(h4.digest(), left4)
+    # pass 2: right2 = right3 ^ ks3, hashed into left1
+    def right2_of(chunk: "tuple[int, bytes]") -> bytes:
+        off, right3 = chunk
+        return ctr_xor(key_3, left3, off - 16, right3)
+
+    h2 = hmac.new(key_2, digestmod="sha256")
+    for chunk in pipelined(right2_of, read_chunks(src, 16)):
+        hmac_update(h2, chunk)
+    left1 = xor_byte_func(h2.digest(), left3)
+
+    # pass 3: right0 = right2 ^ ks1, written out
+    def right0_of(chunk: "tuple[int, bytes]") -> "tuple[int, bytes]":
+        off = chunk[0]
+        return off, ctr_xor(key_1, left1, off - 16, right2_of(chunk))
+
+    write_at(dst, 0, left1)
+    for off, chunk in pipelined(right0_of, read_chunks(src, 16)):
+        write_at(dst, off, chunk)
+    return True
+
+def chunk_keys(keys: "dict[str, bytes]", i: int) -> "dict[str, bytes]":
+    '''
+    Feistel and mac keys for chunk `i` of a chunked file, each the
+    HMAC of the file's key and the chunk index, so every chunk is
+    enciphered and authenticated under its own keys
+    '''
+    tweak = b"fenc-chunk" + i.to_bytes(8, "big")
+    def derive(key: bytes) -> bytes:
+        return hmac.new(key, tweak, digestmod="sha256").digest()[:len(key)]
+    return {"feistel": [derive(k) for k in keys["feistel"]], "mac": derive(keys["mac"])}
+
+def chunk_count(size: int, chunk_size: int) -> int:
+    '''
+    Chunks in a `size`-byte chunked file. A tail under 32 bytes is too
+    short to encrypt alone, so it joins the last full chunk.
+    '''
+    n, tail = divmod(size, chunk_size)
+    return n + (tail >= 32 or not n)
+
+def chunk_span(i: int, size: int, chunk_size: int) -> "tuple[int, int]":
+    start = i * chunk_size
+    end = size if i == chunk_count(size, chunk_size) - 1 else start + chunk_size
+    return start, end
+
+def chunks_mac(keys: "dict[str, bytes]", chunk_macs: "Union[list[str], MacTable]") -> str:
+    '''
+    The file mac of a chunked file: a mac over its chunk macs in order, so
+    chunks cannot be dropped or reordered
+    '''
+    if isinstance(chunk_macs, MacTable):
+        return hash_mac(keys["mac"], chunk_macs.raw())
+    return hash_mac(keys["mac"], b"".join(bytes.fromhex(m) for m in chunk_macs))
+
+def encrypt_chunks(keys: "dict[str, bytes]", src: Union[bytes, mmap], dst,
+                   chunk_size: int) -> "tuple[str, list[str]]":
+    '''
+    Encrypt `src` into `dst` as independent chunks of `chunk_size` bytes.
+    Returns the file mac and the hex mac of each chunk.
+    '''
+    chunk_macs = []
+    for i in range(chunk_count(len(src), chunk_size)):
+        start, end = chunk_span(i, len(src), chunk_size)
+        out = io.BytesIO()
+        chunk_macs.append(feistel_encrypt_stream(chunk_keys(keys, i), src[start:end], out))
+        write_at(dst, start, out.getvalue())
+    return chunks_mac(keys, chunk_macs), chunk_macs
+
+def decrypt_chunk(keys: "dict[str, bytes]", md: dict, src: Union[bytes, mmap],
+                  i: int) -> "Union[bytes, None]":
+    '''
+    The plaintext of chunk `i` of the chunked ciphertext `src`, or None if
+    its mac does not match
+    '''
+    start, end = chunk_span(i, len(src), md["chunk_size"])
+    out = io.BytesIO()
+    if not feistel_decrypt_stream(chunk_keys(keys, i), src[start:end], out, md["chunk_macs"][i]):
+        return None
+    return out.getvalue()
+
+def chunks_valid(keys: "dict[str, bytes]", md: dict, size: int) -> bool:
+    '''
+    Whether the chunk macs in `md` are the ones the file mac was made from
+    and match a `size`-byte file
+    '''
+    return (len(md["chunk_macs"]) == chunk_count(size, md["chunk_size"])
+            and hmac.compare_digest(chunks_mac(keys, md["chunk_macs"]), str(md["mac"])))
+
+def decrypt_chunks(keys: "dict[str, bytes]", src: Union[bytes, mmap], dst, md: dict) -> bool:
+    '''
+    Decrypt the chunked ciphertext `src` into `dst`; False as soon as a mac
+    does not match
+    '''
+    if not chunks_valid(keys, md, len(src)):
+        return False
+    for i in range(len(md["chunk_macs"])):
+        chunk = decrypt_chunk(keys, md, src, i)
+        if chunk is None:
+            return False
+        write_at(dst, chunk_span(i, len(src), md["chunk_size"])[0], chunk)
+    return True
+
+def decrypt_range(keys: "dict[str, bytes]", src: Union[bytes, mmap], md: dict,
+                  offset: int, length: int) -> "Union[bytes, None]":
+    '''
+    Plaintext bytes [offset, offset + length) of the chunked ciphertext
+    `src`, decrypting and authenticating only the chunks they fall in.
+    None if any of those macs does not match.
+    Only their entries of the chunk mac table are read: each chunk's mac
+    is keyed by its index, so a chunk cannot pass for another, while the
+    file mac over the whole table is left to a full decrypt.
+    '''
+    if len(md["chunk_macs"]) != chunk_count(len(src), md["chunk_size"]):
+        return None
+    end = min(offset + length, len(src))
+    last = len(md["chunk_macs"]) - 1
+    first = min(offset // md["chunk_size"], last)
+    stop = min((end - 1) // md["chunk_size"], last) + 1 if offset < end else first
+    parts = []
+    for i in range(first, stop):
+        chunk = decrypt_chunk(keys, md, src, i)
+        if chunk is None:
+            return None
+        start = chunk_span(i, len(src), md["chunk_size"])[0]
+        parts.append(chunk[max(offset - start, 0):end - start])
+    return b"".join(parts)
 
 def xor_byte_func(c: bytes, d: bytes) -> bytes:
-    return bytes([x ^ y for x, y in zip(c, d)])
+    '''
+    XOR two buffers as big integers, truncated to the shorter one like zip
+    '''
+    n = min(len(c), len(d))
+    if not n:
+        return b""
+    x = int.from_bytes(memoryview(c)[:n], "big") ^ int.from_bytes(memoryview(d)[:n], "big")
+    return x.to_bytes(n, "big")
 
 def hmac_rd(key: bytes, left: bytes, right: bytes) -> "list[bytes]":
     hash = hmac.new(key, digestmod="sha256")
     hash.update(right)
     return [xor_byte_func(hash.digest(), left), right]
 
-def is_text(fpath: Path) -> bool:
+def gen_search_terms(fpath: Path, search_key: bytes) -> "list[str]":
     '''
-    Checks if the file is text
+    Sorted hex macs of every star search term in the text file `fpath`
     '''
-    with fpath.open("r", encoding="utf-8") as f:
-        try:
-            f.read()
-            return True
-        except UnicodeDecodeError:
-            return False
-        finally:
-            f.close()
+    with mapped(fpath) as buf:
+        words = text_words(buf)
+    return search_term_macs(words or set(), search_key)
+
+def search_term_macs(words: "set[str]", search_key: bytes) -> "list[str]":
+    '''
+    Sorted hex macs of the star search terms of `words`.
+    Star terms are deduped first so each term is MACed once.
+    '''
+    from unicodedata import normalize
+    terms = set()
+    for w in words:
+        terms.update(normalize("NFC", t.casefold()) for t in gen_star_terms(w))
+    return sorted(mac_terms(search_key, terms))
+
+def text_words(buf: Union[bytes, mmap]) -> "Union[set[str], None]":
+    '''
+    The distinct 4-12 code point words of `buf`, decoded as UTF-8 a chunk
+    at a time; None if `buf` is not UTF-8 text (so not searchable)
+    '''
+    try:
+        return {w for w in iter_words(decode_chunks(buf)) if 4 <= len(w) <= 12}
+    except UnicodeDecodeError:
+        return None
+
+def decode_chunks(buf: Union[bytes, mmap]):
+    '''
+    Yield `buf` decoded as UTF-8, CHUNK_SIZE bytes at a time
+    '''
+    decoder = getincrementaldecoder("utf-8")()
+    for _, chunk in read_chunks(buf, 0):
+        yield decoder.decode(chunk)
+    yield decoder.decode(b"", final=True)
+
+def iter_words(chunks):
+    '''
+    Yield the words of the text split across `chunks`.
+    A word that runs into the end of a chunk is carried into the next one;
+    past 12 characters only its first 13 are kept, since it is too long
+    to be a search term however it ends.
+    '''
+    carry = ""
+    for chunk in chunks:
+        # imported once there is text, so binary input never loads regex
+        from regex import finditer
+        text = carry + chunk
+        carry = ""
+        for m in finditer(WORD_PATTERN, text):
+            if m.end() == len(text):
+                carry = m.group()[:13]
+            else:
+                yield m.group()
+    if carry:
+        yield carry
 
 def gen_star_terms(word: str) -> "list[str]":
     star_terms = []
@@ -340,7 +1715,15 @@ def check_args(args: Namespace):
         exit_error("Error: can't perform multiple functions at the same time.")
     if args.s and (args.e or args.d):
         exit_error("Error: can't combine search with other functions.")
-    if not args.s:
+    if args.journal and not args.r:
+        exit_error("Error: --journal needs -r.")
+    if args.agent_add and (args.e or args.d or args.s or args.r):
+        exit_error("Error: --agent-add takes encrypted files and no other function.")
+    if args.r and not args.s:
+        # files under the directories are checked as the tree is walked
+        if not all([Path(f).exists() for f in args.input]):
+            exit_error("Error: missing file.")
+    elif not args.s:
         files = args.input
         if not all([Path(f).exists() for f in files]):
             exit_error("Error: missing file.")
@@ -349,10 +1732,309 @@ def check_args(args: Namespace):
                 exit_error("Error: file is too small.")
         if args.d:
             files = list(map(Path, files))
-            if not all([Path(".fenc-meta." + f.name).exists() for f in files]):
+            if not all([get_metadata_file(f).exists() for f in files]):
                 exit_error("Error: missing metadata file.")
     if not args.input:
         exit_error("Error: no input provided.")
+    if args.jobs < 0 or args.threads < 0:
+        exit_error("Error: --jobs and --threads must not be negative.")
+    if args.chunk_size and (args.chunk_size < 32 or args.d):
+        exit_error("Error: --chunk-size must be at least 32 and is only used when encrypting.")
+    if args.compress and (args.d or args.s or args.chunk_size):
+        exit_error("Error: --compress is only used when encrypting, without --chunk-size.")
+    if args.range:
+        if not args.d or args.r or len(args.input) != 1:
+            exit_error("Error: --range decrypts part of a single file with -d.")
+        try:
+            offset, length = map(int, args.range.split(":"))
+        except ValueError:
+            offset = length = -1
+        if offset < 0 or length < 0:
+            exit_error("Error: --range takes OFFSET:LEN.")
+
+def verify_file(fname: str, pwd: bytes):
+    '''
+    Check the password before decrypting `fname`; the ciphertext MAC is
+    checked by `Decrypt` on the same read that decrypts it
+    '''
+    md = get_metadata_file(Path(fname))
+    if not md.exists():
+        exit_error(f"No metadata file for: {fname}")
+    with tracking(Path(fname).name, "verify"):
+        if not pwd_authen(pwd, str(md)):
+            exit_error("")
+
+def read_range(fname: str, pwd: bytes, offset: int, length: int, j_flag: bool) -> bytes:
+    '''
+    Decrypt bytes [offset, offset + length) of the chunked file `fname`
+    without changing it
+    '''
+    fpath = Path(fname)
+    with tracking(fpath.name, "range"):
+        md = read_metadata(fname, terms=False)
+        if "chunk_size" not in md or md.get("compression"):
+            exit_error(f"Error: {fname} was not encrypted with --chunk-size.")
+        verify_file(fname, pwd)
+        ctx = key_context(pwd, bytes.fromhex(str(md["salt"])))
+        if j_flag:
+            print(json.dumps({fpath.name: ctx.mk.hex()}, indent=4), file=sys.stderr)
+        with mapped(fpath) as buf:
+            plain = decrypt_range(ctx.keys, buf, md, offset, length)
+        if plain is None:
+            exit_error("")
+        return plain
+
+def run_task(op: str, fname: str, pwd: bytes, j_flag: bool, ctxs: "list[KeyContext]",
+             opts: dict) -> "tuple[str, str, int, list[KeyContext], str]":
+    '''
+    Verify ("v"), encrypt ("e") or decrypt ("d") one file; `opts` holds
+    extra keyword arguments for `Encrypt` or `Decrypt`.
+    Output is captured so the parent can replay it in input order; the key
+    contexts derived here are returned so later tasks can reuse them, along
+    with the staged plaintext of an uncommitted decrypt.
+    '''
+    for ctx in ctxs:
+        key_contexts[(ctx.pwd, ctx.salt)] = ctx
+    seen = set(key_contexts)
+    out, err = io.StringIO(), io.StringIO()
+    code = 0
+    staged = ""
+    with redirect_stdout(out), redirect_stderr(err):
+        try:
+            if op == "v":
+                verify_file(fname, pwd)
+            elif op == "e":
+                Encrypt(Path(fname), pwd, j_flag, **opts)
+            else:
+                staged = str(Decrypt(Path(fname), pwd, j_flag, **opts).staged or "")
+        except SystemExit as e:
+            code = e.code if isinstance(e.code, int) else 1
+        except Exception as e:
+            # reported like exit_error, so one bad file cannot discard the
+            # output of the files before it
+            error_msg(f"Error: {e}")
+            code = 1
+    new = [ctx for k, ctx in key_contexts.items() if k not in seen]
+    return out.getvalue(), err.getvalue(), code, new, staged
+
+def run_jobs(op: str, files: "list[str]", pwds: "list[bytes]", j_flag: bool, jobs: int,
+             ctxs: "list[list[KeyContext]]" = (), opts: "dict | None" = None,
+             staged: "list[str] | None" = None) -> "tuple[list[list[KeyContext]], list[str]]":
+    '''
+    Run `op` over `files`, in worker processes when `jobs` > 1.
+    Output and errors are printed in input order; exits with the first
+    failing task's status once every task has reported, removing any
+    staged plaintexts first.
+    Returns each task's new key contexts and staged plaintext path. Staged
+    paths are also appended to `staged` as each task reports, so the caller
+    can remove them if the run is interrupted before it returns.
+    '''
+    from concurrent.futures import ProcessPoolExecutor
+    n = len(files)
+    args = (repeat(bool(stats_hooks)), repeat(run_task),
+            repeat(op), files, pwds, repeat(j_flag), ctxs or repeat([]), repeat(opts or {}))
+    tracked = [] if staged is None else staged
+    results = []
+    if jobs > 1 and n > 1:
+        with ProcessPoolExecutor(min(jobs, n), initializer=set_cipher_threads,
+                                 initargs=(cipher_threads,)) as pool:
+            futures = [pool.submit(collect_stats, *a) for a in zip(*args)]
+            try:
+                for f in futures:
+                    results.append(f.result())
+                    tracked.append(results[-1][0][4])
+            finally:
+                # tasks still running when the run is interrupted finish
+                # first, so their staged output is known and can be removed
+                pool.shutdown(cancel_futures=True)
+                for f in futures[len(results):]:
+                    if f.done() and not f.cancelled() and f.exception() is None:
+                        tracked.append(f.result()[0][4])
+    else:
+        for result in map(collect_stats, *args):
+            results.append(result)
+            tracked.append(result[0][4])
+    status = 0
+    for (out, err, code, _, _), stats in results:
+        sys.stdout.write(out)
+        sys.stderr.write(err)
+        for st in stats:
+            report_stats(st)
+        status = status or code
+    sys.stdout.flush()
+    staged = [path for (*_, path), _ in results]
+    if status:
+        for path in filter(None, staged):
+            Path(path).unlink(missing_ok=True)
+        sys.exit(status)
+    return [new for (_, _, _, new, _), _ in results], staged
+
+class Journal:
+    '''
+    Append-only record of the files a tree run has finished, one JSON line
+    each, so rerunning with the same journal skips them
+    '''
+    def __init__(self, path: str, op: str):
+        self.op = op
+        self.done = set()
+        self.f = None
+        if not path:
+            return
+        line = "\n"
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # a line cut short by an interrupted run
+                        continue
+                    if entry.get("op") == op:
+                        self.done.add(entry["path"])
+        self.f = open(path, "a", encoding="utf-8")
+        if not line.endswith("\n"):
+            self.f.write("\n")
+
+    def __contains__(self, fname: str) -> bool:
+        return os.path.abspath(fname) in self.done
+
+    def record(self, fname: str):
+        if self.f:
+            self.f.write(json.dumps({"op": self.op, "path": os.path.abspath(fname)}) + "\n")
+            self.f.flush()
+
+    def close(self):
+        if self.f:
+            os.fsync(self.f.fileno())
+            self.f.close()
+
+def prefetch(fname: str):
+    '''
+    Ask the OS to start reading `fname` in the background
+    '''
+    if hasattr(os, "posix_fadvise"):
+        fd = os.open(fname, os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        finally:
+            os.close(fd)
+
+def tree_item(op: str, fname: str, done: Journal) -> "Union[tuple[str, str, int], None]":
+    '''
+    Decide what a tree run does with `fname`: None to pass over it
+    silently, (fname, note, status) to report why it is skipped, or
+    (fname, "", 0) to process it, in which case it is prefetched
+    '''
+    path = Path(fname)
+    if is_fenc_file(path.name) or fname in done:
+        return None
+    md_file = get_metadata_file(path)
+    if md_file.parent != path.parent and (md_file.parent / path.name).is_file():
+        # examples/x shares its metadata name with its parent's x; leaving it
+        # encrypted is safe, leaving it plaintext is an error
+        note = f"shares its metadata file with {md_file.parent / path.name}."
+        if op == "e":
+            return fname, f"Error: {fname} {note}", 1
+        return fname, f"Skipping {fname}: {note}", 0
+    has_md = md_file.exists()
+    if op == "d" and not has_md:
+        return None
+    if op == "e" and has_md:
+        return fname, f"Skipping {fname}: Already Encrypted.", 0
+    if op == "e" and os.path.getsize(fname) < 32:
+        return fname, f"Skipping {fname}: file is too small.", 0
+    prefetch(fname)
+    return fname, "", 0
+
+def tree_task(op: str, fname: str, pwd: bytes, j_flag: bool, opts: dict) -> tuple:
+    '''
+    One file of `run_tree`: `run_task`, checking the password first when
+    decrypting. Key contexts are dropped afterwards, since each file has
+    its own salt and a long run would otherwise keep them all.
+    '''
+    try:
+        if op == "d":
+            result = run_task("v", fname, pwd, j_flag, [], {})
+            if result[2]:
+                return result
+        return run_task(op, fname, pwd, j_flag, [], opts)
+    finally:
+        key_contexts.clear()
+
+def run_tree(op: str, roots: "list[str]", pwd: bytes, j_flag: bool, jobs: int,
+             opts: "dict | None" = None, journal: str = ""):
+    '''
+    Encrypt ("e") or decrypt ("d") every file under `roots` with one password.
+    A thread walks the tree lazily and prefetches each file into a bounded
+    queue, so directory walks and reads overlap the cipher and key
+    derivation running here or in `jobs` worker processes. Each file is
+    committed on its own; finished files are appended to `journal` and
+    skipped when the run is repeated. Output is printed in walk order and
+    the run exits with the first failing file's status at the end.
+    '''
+    from concurrent.futures import ProcessPoolExecutor
+    done = Journal(journal, op)
+    ahead = 2 * jobs
+    todo = queue.Queue(maxsize=ahead)
+    skip = os.path.abspath(journal) if journal else ""
+
+    def walk():
+        # errors are queued like skipped files, so they are reported in walk
+        # order and fail the run instead of ending the walk early
+        def failed(e: OSError):
+            todo.put((e.filename or "", f"Error: {e}", 1))
+        try:
+            for root in roots:
+                for fname in walk_tree(root, failed) if os.path.isdir(root) else [root]:
+                    try:
+                        item = None if os.path.abspath(fname) == skip else tree_item(op, fname, done)
+                    except OSError as e:
+                        item = (fname, f"Error: {e}", 1)
+                    if item:
+                        todo.put(item)
+        except Exception as e:
+            todo.put(("", f"Error: {e}", 1))
+        finally:
+            todo.put(None)
+
+    def finish(fname: str, result) -> int:
+        (out, err, code, _, _), stats = result.result() if pool else result
+        sys.stdout.write(out)
+        sys.stderr.write(err)
+        for st in stats:
+            report_stats(st)
+        if not code:
+            done.record(fname)
+        return code
+
+    threading.Thread(target=walk, daemon=True).start()
+    pool = ProcessPoolExecutor(jobs, initializer=set_cipher_threads,
+                               initargs=(cipher_threads,)) if jobs > 1 else None
+    pending = deque()
+    status = 0
+    try:
+        while True:
+            item = todo.get()
+            if item is None:
+                break
+            fname, note, code = item
+            if note:
+                error_msg(note)
+                status = status or code
+                continue
+            args = (bool(stats_hooks), tree_task, op, fname, pwd, j_flag, opts or {})
+            pending.append((fname, pool.submit(collect_stats, *args) if pool else collect_stats(*args)))
+            while len(pending) > (ahead if pool else 0):
+                status = finish(*pending.popleft()) or status
+        while pending:
+            status = finish(*pending.popleft()) or status
+    finally:
+        if pool:
+            pool.shutdown(cancel_futures=True)
+        done.close()
+        sys.stdout.flush()
+    if status:
+        sys.exit(status)
 
 # parser
 
@@ -363,35 +2045,88 @@ if __name__ == "__main__":
     parser.add_argument("-d", action="store_true", help="decrypt")
     parser.add_argument("-s", action="store_true", help="search")
     parser.add_argument("-j", action="store_true", help="json")
+    parser.add_argument("--jobs", type=int, default=1, metavar="N",
+                        help="use N worker processes (0: one per CPU)")
+    parser.add_argument("--threads", type=int, default=1, metavar="N",
+                        help="run the cipher of each file on N threads (0: one per CPU)")
+    parser.add_argument("--stats", action="store_true",
+                        help="print per-file and total phase timings as JSON to stderr")
+    parser.add_argument("--meta-format", choices=["json", "binary"], default="json",
+                        help="metadata format to write when encrypting")
+    parser.add_argument("--chunk-size", type=int, default=0, metavar="BYTES",
+                        help="encrypt in independently authenticated chunks of BYTES, "
+                             "so --range can decrypt part of the file")
+    parser.add_argument("--compress", choices=COMPRESSIONS, default="",
+                        help="compress files before encrypting them")
+    parser.add_argument("--range", default="", metavar="OFFSET:LEN",
+                        help="with -d, write plaintext bytes OFFSET to OFFSET+LEN of one chunked "
+                             "file to stdout, leaving it encrypted")
+    parser.add_argument("--agent", action="store_true",
+                        help="run a key agent that holds master keys for $FENC_AGENT_SOCK clients "
+                             "(an added file unlocks without its password, as with ssh-agent)")
+    parser.add_argument("--agent-add", action="store_true",
+                        help="check the password of each encrypted input file and add its master "
+                             "key to the key agent")
+    parser.add_argument("--agent-sock", default="", metavar="PATH", help="agent socket path")
+    parser.add_argument("--agent-ttl", type=float, default=900, metavar="SECONDS",
+                        help="how long the agent keeps a key")
+    parser.add_argument("--agent-max", type=int, default=1024, metavar="N",
+                        help="most keys the agent holds at once")
+    parser.add_argument("-r", action="store_true",
+                        help="encrypt or decrypt every file under directory inputs with one password; "
+                             "search metadata under the current directory")
+    parser.add_argument("--journal", default="", metavar="PATH",
+                        help="with -r, record finished files in PATH and skip those already recorded")
     parser.add_argument("input", nargs="*", help="file or search terms")
     args = parser.parse_args()
+    if args.agent:
+        run_agent(args.agent_sock, args.agent_ttl, args.agent_max)
+        sys.exit(0)
     check_args(args)
-    if args.d:
-        pwds = []
-        for d in args.input:
-            pwd = get_pwd(d)
-            pwds.append(pwd)
-            mdf = list(Path.cwd().glob(f".fenc-meta.{Path(d).name}."))
-            if not mdf:
-                exit_error(f"No metadata file for: {d}")
-            else:
-                md = str(mdf[0])
-                if not pwd_authen(pwd, md):
-                    exit_error("")
-                if not mac_authen(pwd, md, d):
-                    exit_error("")
-        for i, d in enumerate(args.input):
-            Decrypt(Path(d), pwds[i], args.j)
+    if args.agent_add:
+        for f in args.input:
+            agent_add(f, get_pwd(f))
+        sys.exit(0)
+    jobs = args.jobs or os.cpu_count() or 1
+    set_cipher_threads(args.threads or os.cpu_count() or 1)
+    file_stats_list = []
+    if args.stats:
+        add_stats_hook(file_stats_list.append)
+        # reported even when a task exits with an error
+        atexit.register(lambda: print(json.dumps(summarize_stats(file_stats_list), indent=4),
+                                      file=sys.stderr))
+    if args.range:
+        offset, length = map(int, args.range.split(":"))
+        d = args.input[0]
+        sys.stdout.buffer.write(read_range(d, get_pwd(d), offset, length, args.j))
+        sys.stdout.flush()
+    elif args.d and not args.r:
+        pwds = [get_pwd(d) for d in args.input]
+        staged = []
+        try:
+            ctxs, _ = run_jobs("v", args.input, pwds, args.j, jobs)
+            # every file must pass its MAC check before any ciphertext is replaced
+            run_jobs("d", args.input, pwds, args.j, jobs, ctxs, {"commit": False}, staged)
+            for d, path in zip(args.input, staged):
+                commit_decrypted(Path(d), Path(path))
+        finally:
+            # an interrupted run leaves no staged plaintext behind; committed
+            # ones have already been renamed over their ciphertexts
+            for path in filter(None, staged):
+                Path(path).unlink(missing_ok=True)
     if args.s:
-        md_files = list(Path.cwd().glob(".fenc-meta.*"))
-        if not md_files:
+        if next(find_metadata(args.r), None) is None:
             exit_error("No files exit.")
-        Search(args.input, args.j)
-    if not args.d and not args.s:
+        Search(args.input, args.j, jobs, args.r)
+    opts = {"meta_format": args.meta_format, "chunk_size": args.chunk_size,
+            "compression": args.compress}
+    if args.r and not args.s:
+        run_tree("d" if args.d else "e", args.input, get_pwd(), args.j, jobs,
+                 {} if args.d else opts, args.journal)
+    elif not args.d and not args.s:
         for f in args.input:
-            md_files = list(Path.cwd().glob(f".fenc-meta.{Path(f).name}"))
-            if md_files:
+            if get_metadata_file(Path(f)).exists():
                 exit_error(f"Error: {f} Already Encrypted.")
-        for f in args.input:
-            Encrypt(Path(f), get_pwd(), args.j)
+        pwds = [get_pwd() for _ in args.input]
+        run_jobs("e", args.input, pwds, args.j, jobs, opts=opts)
     # print(args)
@@ -3,8 +3,14 @@ Unit tests
 '''
 
 from fencrypt import *
+from Crypto.Cipher import AES
+from io import BytesIO
 from json import load
+from regex import findall
+from tempfile import TemporaryDirectory
+from unicodedata import normalize
 from unittest import TestCase, main
+from unittest.mock import patch
 
 def master_key(pwd: str, salt: str) -> str:
     mk = pbkdf2_hmac('sha256', pwd.encode('utf-8'), bytes.fromhex(salt), 250_000)
@@ -56,6 +62,17 @@ def feistel_dec(keys: list[str], _ciphertext: str) -> str:
     left0, right0 = aes_rd(key_1, left1, right1)
     return (left0 + right0).hex()
 
+def feistel_enc_stream(keys: list[str], _plaintext: str) -> str:
+    f = BytesIO()
+    feistel_encrypt_stream({"feistel": [bytes.fromhex(k) for k in keys], "mac": b"mac"},
+                           bytes.fromhex(_plaintext), f)
+    return f.getvalue().hex()
+
+def feistel_dec_stream(keys: list[str], _ciphertext: str) -> str:
+    f = BytesIO()
+    feistel_decrypt_stream({"feistel": [bytes.fromhex(k) for k in keys]}, bytes.fromhex(_ciphertext), f)
+    return f.getvalue().hex()
+
 def mac(_key: str, _data: str) -> str: 
     key = bytes.fromhex(_key)
     data = bytes.fromhex(_data)
@@ -186,6 +203,309 @@ class Test1(TestCase):
     def test_prob6(self):
         assert feistel_dec(prob6_keys, prob6_data) == prob6_expect
     
+    def test_prob5_stream(self):
+        assert feistel_enc_stream(prob5_keys, prob5_data) == prob5_expect
+
+    def test_prob6_stream(self):
+        assert feistel_dec_stream(prob6_keys, prob6_data) == prob6_expect
+
+    def test_stream_chunks(self):
+        # inputs spanning many chunks, ending mid chunk and on a boundary
+        keys = [token_bytes(16).hex() for _ in range(4)]
+        with patch("fencrypt.CHUNK_SIZE", 48):
+            for size in (32, 64, 16 + 48 * 5, 16 + 48 * 5 + 7, 1000):
+                pt = token_bytes(size).hex()
+                ct = feistel_enc(keys, pt)
+                assert feistel_enc_stream(keys, pt) == ct, size
+                assert feistel_dec_stream(keys, ct) == pt, size
+                stream_keys = {"feistel": [bytes.fromhex(k) for k in keys], "mac": b"mac"}
+                mac_ct = BytesIO()
+                mac = feistel_encrypt_stream(stream_keys, bytes.fromhex(pt), mac_ct)
+                assert mac == hmac.new(b"mac", bytes.fromhex(ct), digestmod="sha256").hexdigest()
+                assert feistel_decrypt_stream(stream_keys, mac_ct.getvalue(), BytesIO(), mac)
+
+    def test_cipher_threads(self):
+        # chunks handed out to 4 threads come back in order
+        keys = {"feistel": [token_bytes(16) for _ in range(4)], "mac": b"mac"}
+        pt = token_bytes(16 + 48 * 40 + 5)
+        expect = bytes.fromhex(feistel_enc([k.hex() for k in keys["feistel"]], pt.hex()))
+        set_cipher_threads(4)
+        try:
+            with patch("fencrypt.CHUNK_SIZE", 48):
+                ct = BytesIO()
+                mac = feistel_encrypt_stream(keys, pt, ct)
+                assert ct.getvalue() == expect
+                out = BytesIO()
+                assert feistel_decrypt_stream(keys, ct.getvalue(), out, mac)
+                assert out.getvalue() == pt
+        finally:
+            set_cipher_threads(1)
+
+    def test_text_words_chunks(self):
+        # words longer than 12 characters and multibyte characters cut at
+        # every possible chunk boundary
+        text = ("Tomorrow, and tomorrow, and tomorrow creeps in this petty pace "
+                "incomprehensibilities Straße naïve 日本語のテキスト café "
+                "Ωmegaλambda 😀emoji😀 antidisestablishmentarianism end")
+        buf = text.encode("utf-8")
+        key = token_bytes(32)
+        expect = sorted(mac_terms(key, set(search_terms(text))))
+        for size in range(1, 24):
+            with patch("fencrypt.CHUNK_SIZE", size):
+                words = text_words(buf)
+            assert words == set(search_ascii(text)), size
+            assert search_term_macs(words, key) == expect, size
+        with patch("fencrypt.CHUNK_SIZE", 5):
+            assert text_words("naïve".encode("utf-8")[:3]) is None
+
+    def test_decrypt_mac_check(self):
+        keys = {"feistel": [bytes.fromhex(k) for k in prob5_keys], "mac": b"mac"}
+        ct = BytesIO()
+        mac = feistel_encrypt_stream(keys, bytes.fromhex(prob5_data), ct)
+        pt = BytesIO()
+        assert feistel_decrypt_stream(keys, ct.getvalue(), pt, mac)
+        assert pt.getvalue().hex() == prob5_data
+        tampered = bytearray(ct.getvalue())
+        tampered[-1] ^= 1
+        pt = BytesIO()
+        assert not feistel_decrypt_stream(keys, bytes(tampered), pt, mac)
+        assert not pt.getvalue()
+
+    def test_term_index(self):
+        macs = sorted(token_bytes(32) for _ in range(100))
+        index = TermIndex(b"".join(macs))
+        assert all(m in index for m in macs)
+        assert token_bytes(32) not in index
+        assert macs[0] not in TermIndex(b"")
+
+    def test_binary_metadata(self):
+        md = {"salt": token_bytes(16).hex(), "validator": token_bytes(16).hex(),
+              "mac": token_bytes(32).hex(), "terms": sorted(token_bytes(32).hex() for _ in range(5))}
+        path = Path.cwd() / ".fenc-meta.binary-test"
+        try:
+            write_binary_metadata(path, md)
+            header = read_metadata(str(path), False, terms=False)
+            assert "terms" not in header and header["terms_count"] == 5
+            assert all(header[k] == md[k] for k in ("salt", "validator", "mac"))
+            assert read_metadata(str(path), False)["terms"] == md["terms"]
+        finally:
+            path.unlink()
+
+    def test_key_agent(self):
+        agent = KeyAgent(ttl=60, max_keys=2)
+        for i in range(3):
+            agent.put(str(i), bytes([i]) * 32)
+        assert agent.get("0") == b""
+        assert agent.get("2") == bytes([2]) * 32
+        assert agent.handle({"op": "get", "salt": "2"}) == {"mk": (bytes([2]) * 32).hex()}
+        assert agent.handle({"op": "put", "salt": "3", "mk": bytes(32).hex()}) == {"ok": True}
+        # keys only reach the agent through agent_add
+        with patch("fencrypt.agent_put") as put, TemporaryDirectory() as d:
+            (Path(d) / "a.txt").write_bytes(b"tomorrow, and tomorrow, and tomorrow, creeps in")
+            Encrypt(Path(d) / "a.txt", b"pwd", False)
+            ct, md = encrypt_bytes(bytes(64), b"pwd")
+            decrypt_bytes(ct, b"pwd", md)
+            put.assert_not_called()
+        expired = KeyAgent(ttl=-1)
+        expired.put("0", bytes(32))
+        assert expired.get("0") == b""
+
+    def test_stats_hook(self):
+        seen = []
+        add_stats_hook(seen.append)
+        try:
+            with tracking("file", "encrypt"):
+                KeyContext(b"pwd", token_bytes(16))
+        finally:
+            stats_hooks.remove(seen.append)
+        assert [s["file"] for s in seen] == ["file"]
+        assert seen[0]["phases"]["kdf"]["calls"] == 1
+        assert summarize_stats(seen)["total"]["phases"]["kdf"]["calls"] == 1
+
+    def test_library_api(self):
+        data = "Crickets sing in the Straße at night.".encode("utf-8")
+        cached = len(key_contexts)
+        ct, md = encrypt_bytes(data, b"pwd")
+        assert ct != data and len(ct) == len(data)
+        assert decrypt_bytes(ct, b"pwd", md) == data
+        assert search_metadata(md, b"pwd", ["crickets", "stra*", "nothing"]) == ["crickets", "stra*"]
+        asked = ["CRICKETS", "STRASSE", normalize("NFD", "Straße"), "Night"]
+        assert search_metadata(md, b"pwd", asked) == asked
+        with self.assertRaises(ValueError):
+            decrypt_bytes(ct[:-1] + bytes([ct[-1] ^ 1]), b"pwd", md)
+        with self.assertRaises(ValueError):
+            search_metadata(md, b"wrong", ["crickets"])
+        # the library keeps no passwords or keys
+        assert len(key_contexts) == cached
+
+    def test_chunked(self):
+        data = token_bytes(1000)
+        ct, md = encrypt_bytes(data, b"pwd", chunk_size=64)
+        assert len(md["chunk_macs"]) == 16
+        assert decrypt_bytes(ct, b"pwd", md) == data
+        for offset, length in [(0, 1), (60, 10), (128, 64), (900, 500), (1000, 5)]:
+            assert decrypt_bytes_range(ct, b"pwd", md, offset, length) == data[offset:offset + length]
+        # identical plaintext chunks encrypt differently
+        ct, md = encrypt_bytes(bytes(256), b"pwd", chunk_size=64)
+        assert len({ct[i:i + 64] for i in range(0, 256, 64)}) == 4
+        tampered = ct[:200] + bytes([ct[200] ^ 1]) + ct[201:]
+        assert decrypt_bytes_range(tampered, b"pwd", md, 0, 128) == bytes(128)
+        with self.assertRaises(ValueError):
+            decrypt_bytes_range(tampered, b"pwd", md, 150, 64)
+        with self.assertRaises(ValueError):
+            decrypt_bytes(tampered, b"pwd", md)
+        # binary metadata keeps the chunk macs as a raw table
+        with TemporaryDirectory() as d:
+            path = Path(d) / "data.bin"
+            path.write_bytes(data)
+            Encrypt(path, b"pwd", False, meta_format="binary", chunk_size=64)
+            md = read_metadata(str(path), terms=False)
+            assert isinstance(md["chunk_macs"], MacTable) and len(md["chunk_macs"]) == 16
+            assert read_range(str(path), b"pwd", 100, 200, False) == data[100:300]
+            # a chunk mac is only accepted for its own chunk
+            md_path = Path(d) / ".fenc-meta.data.bin"
+            raw = bytearray(md_path.read_bytes())
+            at = md["chunk_macs"].start + 2 * MacTable.WIDTH
+            raw[at:at + 32], raw[at + 32:at + 64] = raw[at + 32:at + 64], raw[at:at + 32]
+            md_path.write_bytes(bytes(raw))
+            assert read_range(str(path), b"pwd", 0, 128, False) == data[:128]
+            with self.assertRaises(SystemExit):
+                read_range(str(path), b"pwd", 128, 64, False)
+
+    def test_compressed(self):
+        data = b"tomorrow, and tomorrow, and tomorrow\n" * 2000
+        ct, md = encrypt_bytes(data, b"pwd", compression="zlib")
+        assert md["compression"] == "zlib" and len(ct) < len(data) // 10
+        assert decrypt_bytes(ct, b"pwd", md) == data
+        assert search_metadata(md, b"pwd", ["tomorrow"]) == ["tomorrow"]
+        # incompressible input is stored as is
+        data = token_bytes(1000)
+        ct, md = encrypt_bytes(data, b"pwd", compression="zlib")
+        assert "compression" not in md and len(ct) == len(data)
+        assert decrypt_bytes(ct, b"pwd", md) == data
+
+    def test_query(self):
+        words = {"tomorrow", "creeps", "petty*"}
+        asked = []
+
+        def contains(t):
+            asked.append(t)
+            return t in words
+        for q, expect in [("tomorrow", True), ("nothing tomorrow", True),
+                          ("Tomorrow AND nothing", False), ("NOT nothing AND petty*", True),
+                          ("(nothing OR creeps) AND NOT tomorrow", False)]:
+            assert query_match(parse_query(q.split()), contains) == expect, q
+        # an AND stops at its first missing term
+        asked.clear()
+        assert not query_match(parse_query(["nothing", "AND", "tomorrow"]), contains)
+        assert asked == ["nothing"]
+        for bad in ([], ["AND"], ["NOT"], ["(tomorrow"], ["tomorrow", ")"]):
+            with self.assertRaises(ValueError):
+                parse_query(bad)
+        ct, md = encrypt_bytes(b"tomorrow, and tomorrow, and tomorrow, creeps in", b"pwd")
+        assert match_metadata(md, b"pwd", ["tomorrow AND creeps"])
+        assert not match_metadata(md, b"pwd", ["tomorrow", "AND", "NOT", "creeps"])
+
+    def test_catalog(self):
+        with TemporaryDirectory() as d:
+            plain = b"tomorrow, and tomorrow, and tomorrow, creeps in"
+            for name in ("a.txt", "b.txt"):
+                (Path(d) / name).write_bytes(plain)
+                Encrypt(Path(d) / name, b"pwd", False, meta_format="binary" if name == "b.txt" else "json")
+            Decrypt(Path(d) / "a.txt", b"pwd", False)
+            with Catalog(Path(d)) as catalog:
+                entries = dict(catalog.entries())
+            assert list(entries) == ["b.txt"]
+            md = read_metadata(str(Path(d) / ".fenc-meta.b.txt"), False, terms=False)
+            assert all(entries["b.txt"][k] == md[k] for k in ("salt", "validator", "mac", "terms_offset"))
+            assert search_file(str(Path(d) / ".fenc-meta.b.txt"), b"pwd", parse_query(["creeps"]),
+                               entries["b.txt"])[2]
+            # rows whose metadata was removed or rewritten outside fencrypt
+            (Path(d) / "c.txt").write_bytes(plain)
+            Encrypt(Path(d) / "c.txt", b"pwd", False)
+            (Path(d) / ".fenc-meta.b.txt").unlink()
+            md = read_metadata(str(Path(d) / ".fenc-meta.c.txt"), False)
+            md["salt"] = token_bytes(16).hex()
+            (Path(d) / ".fenc-meta.c.txt").write_text(json.dumps(md), encoding="utf-8")
+            with Catalog(Path(d)) as catalog:
+                entries = catalog.current(["c.txt"])
+                assert entries["c.txt"]["salt"] == md["salt"]
+                assert [name for name, _ in catalog.entries()] == ["c.txt"]
+        # an unchanged directory is listed from its catalog without a scan
+        with TemporaryDirectory() as d:
+            for name in ("a.txt", "b.txt"):
+                (Path(d) / name).write_bytes(plain)
+                Encrypt(Path(d) / name, b"pwd", False)
+            past = time.time_ns() - 10 * Catalog.RACY_NS
+            os.utime(d, ns=(past, past))
+            with Catalog(Path(d)) as catalog:
+                assert list(catalog.listing()) == ["a.txt", "b.txt"]
+            (Path(d) / ".fenc-meta.b.txt").rename(Path(d) / "moved")
+            os.utime(d, ns=(past, past))
+            with Catalog(Path(d)) as catalog:
+                assert list(catalog.listing()) == ["a.txt", "b.txt"]
+            os.utime(d, ns=(past + 1, past + 1))
+            with Catalog(Path(d)) as catalog:
+                assert list(catalog.listing()) == ["a.txt"]
+            # decrypting the last file listed removes the catalog
+            Decrypt(Path(d) / "a.txt", b"pwd", False)
+            assert not (Path(d) / CATALOG_NAME).exists()
+        # search reads the metadata itself rather than creating a catalog
+        with TemporaryDirectory() as d:
+            (Path(d) / "a.txt").write_bytes(plain)
+            Encrypt(Path(d) / "a.txt", b"pwd", False)
+            (Path(d) / CATALOG_NAME).unlink()
+            cwd = os.getcwd()
+            os.chdir(d)
+            try:
+                assert list(find_metadata()) == [(".fenc-meta.a.txt", None)]
+            finally:
+                os.chdir(cwd)
+            assert not (Path(d) / CATALOG_NAME).exists()
+
+    def test_run_jobs(self):
+        with TemporaryDirectory() as d:
+            (Path(d) / "dir").mkdir()
+            files = [str(Path(d) / name) for name in ("a.txt", "dir", "b.txt")]
+            for f in files[::2]:
+                Path(f).write_bytes(b"tomorrow, and tomorrow, and tomorrow, creeps in")
+            out = io.StringIO()
+            with redirect_stdout(out), redirect_stderr(io.StringIO()), self.assertRaises(SystemExit) as e:
+                run_jobs("e", files, [b"pwd"] * 3, True, 1)
+            # the directory fails, but every file's output is still printed in order
+            assert e.exception.code == 1
+            assert [list(json.loads(k)) for k in findall(r"\{[^}]*\}", out.getvalue())] == [["a.txt"], ["b.txt"]]
+
+    def test_tree(self):
+        with TemporaryDirectory() as d:
+            plain = b"tomorrow, and tomorrow, and tomorrow, creeps in"
+            root = Path(d) / "t"
+            (root / "examples").mkdir(parents=True)
+            for name in ("a.txt", "b.txt", "examples/a.txt", "examples/c.txt"):
+                (root / name).write_bytes(plain + name.encode("utf-8"))
+            journal = str(Path(d) / "journal")
+            unreadable = str(root / "b.txt")
+
+            def fail_b(fname):
+                if fname == unreadable:
+                    raise PermissionError(13, "Permission denied", fname)
+            with patch("fencrypt.prefetch", fail_b), self.assertRaises(SystemExit) as e:
+                run_tree("e", [str(root)], b"pwd", False, 1, journal=journal)
+            # b.txt fails and examples/a.txt would share a.txt's metadata
+            assert e.exception.code == 1
+            assert (root / ".fenc-meta.a.txt").exists() and (root / ".fenc-meta.c.txt").exists()
+            assert (root / "b.txt").read_bytes() == plain + b"b.txt"
+            assert (root / "examples/a.txt").read_bytes() == plain + b"examples/a.txt"
+            with open(journal, "r", encoding="utf-8") as f:
+                assert len(f.readlines()) == 2
+            # the journal skips the files already done
+            (root / "examples/a.txt").unlink()
+            run_tree("e", [str(root)], b"pwd", False, 1, journal=journal)
+            assert (root / ".fenc-meta.b.txt").exists()
+            run_tree("d", [str(root)], b"pwd", False, 1)
+            for name in ("a.txt", "b.txt", "examples/c.txt"):
+                assert (root / name).read_bytes() == plain + name.encode("utf-8")
+
     def test_prob7(self):
         assert mac(prob7_key, prob7_data) == prob7_expect
 
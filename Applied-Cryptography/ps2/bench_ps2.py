@@ -0,0 +1,247 @@
+'''
+Benchmarks
+
+Generates problem sets of synthetic 16-byte trade records ("S MSFT: 1000    ")
+encrypted under AES-ECB and AES-CTR, times and memory-profiles answer1
+through answer4 on them, and checks every answer by decrypting it. The
+answers must also still match example-output.json on example-input.json.
+
+    python bench_ps2.py --sizes 1K,1M,10M -o before.json
+    python bench_ps2.py --sizes 1K,1M,10M -o after.json --compare before.json
+    python bench_ps2.py --sizes 1M --write-input big-input.json
+'''
+
+import json
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+from argparse import ArgumentParser
+from pathlib import Path
+from random import Random
+from typing import Callable
+
+from Crypto.Cipher import AES
+
+import ps2
+
+HERE = Path(__file__).parent
+UNITS = {"K": 1_000, "M": 1_000_000}
+TICKERS = ["AAPL", "MSFT", "GOOG", "AMZN", "TSLA", "NVDA", "META", "INTC", "ORCL", "IBM "]
+# the largest share count int2bytes can pad to 8 bytes
+MAX_SHARES = 99_999_999
+
+def parse_size(s: str) -> int:
+    s = s.strip().upper()
+    if s[-1] in UNITS:
+        return int(float(s[:-1]) * UNITS[s[-1]])
+    return int(s)
+
+def gen_trades(rng: Random, n: int) -> bytes:
+    '''
+    `n` 16-byte trade records: B/S, ticker, share count padded with spaces
+    '''
+    ops = rng.choices("BS", k=n)
+    tickers = rng.choices(TICKERS, k=n)
+    return "".join(f"{op} {t}: {rng.randint(1, 99_999):<8}"
+                   for op, t in zip(ops, tickers)).encode("utf-8")
+
+def ecb(key: bytes) -> "AES":
+    return AES.new(key, AES.MODE_ECB)
+
+def ctr(key: bytes, nonce: bytes) -> "AES":
+    return AES.new(key, AES.MODE_CTR, nonce=nonce)
+
+def blocks_of(buf: bytes) -> "list[bytes]":
+    return [buf[i:i + 16] for i in range(0, len(buf), 16)]
+
+def gen_problem_set(blocks: int, seed: int) -> "tuple[dict, dict]":
+    '''
+    An example-input.json style problem set with about `blocks` trade
+    blocks in each problem, and what is needed to check the answers
+    '''
+    rng = Random(seed)
+    ecb_key, ctr_key, nonce = rng.randbytes(16), rng.randbytes(16), rng.randbytes(8)
+    secret = {"ecb_key": ecb_key, "ctr_key": ctr_key, "nonce": nonce}
+
+    # problem 1: cut and paste ECB blocks of an old ledger into new ones
+    old_pt = gen_trades(rng, blocks)
+    old_blocks = blocks_of(old_pt)
+    new_pt = []
+    for _ in range(4):
+        n = max(blocks // 4, 1)
+        fresh = blocks_of(gen_trades(rng, n))
+        new_pt.append(b"".join(rng.choice(old_blocks) if rng.random() < 0.5 else fresh[i]
+                               for i in range(n)))
+    p1 = {
+        "old_pt": old_pt.hex(),
+        "old_ct": ecb(ecb_key).encrypt(old_pt).hex(),
+        "op_1": "S", "co_1": "MSFT", "op_2": "S", "co_2": "AAPL",
+        "new_trades": [ecb(ecb_key).encrypt(pt).hex() for pt in new_pt],
+    }
+    secret["new_pt"] = new_pt
+
+    # problem 2: a second message under the same CTR keystream
+    old_pt = gen_trades(rng, blocks)
+    new_pt = gen_trades(rng, max(blocks // 2, 1))
+    p2 = {
+        "old_pt": old_pt.hex(),
+        "old_ct": ctr(ctr_key, nonce).encrypt(old_pt).hex(),
+        "new_ct": ctr(ctr_key, nonce).encrypt(new_pt).hex(),
+    }
+    secret["p2_pt"] = new_pt
+
+    # problem 3: today's CTR trades, to be flipped between B and S
+    todays_pt = gen_trades(rng, blocks)
+    p3 = {"todays_ct": ctr(ctr_key, nonce).encrypt(todays_pt).hex()}
+    secret["p3_pt"] = todays_pt
+
+    # problem 4: single CTR trades whose share counts are known, encrypted
+    # at consecutive counters so one cipher call covers them all
+    trades_pt = gen_trades(rng, blocks)
+    trades = blocks_of(trades_pt)
+    p4 = {
+        "trade_list": [b.hex() for b in blocks_of(ctr(ctr_key, nonce).encrypt(trades_pt))],
+        "expected_num": [int(t[8:16]) for t in trades],
+        "actual_num": [rng.randint(1, MAX_SHARES) for _ in trades],
+    }
+    secret["p4_pt"] = trades
+
+    inputs = {"problem 1": p1, "problem 2": p2, "problem 3": p3, "problem 4": p4}
+    return inputs, secret
+
+def flip(pt: bytes) -> bytes:
+    '''
+    `pt` with the B/S byte of every trade swapped
+    '''
+    out = bytearray(pt)
+    out[0::16] = bytes(b ^ 0x11 for b in pt[0::16])
+    return bytes(out)
+
+def check(n: int, answer, inputs: dict, secret: dict):
+    '''
+    Decrypt answer `n` and compare it with what the attack should produce
+    '''
+    if n == 1:
+        p1 = inputs["problem 1"]
+        old_blocks = blocks_of(bytes.fromhex(p1["old_pt"]))
+        swap = {b for b in old_blocks if b[:6] == b"S MSFT"}
+        best = max((b for b in old_blocks if b[:6] == b"S AAPL"), key=lambda b: int(b[8:16]), default=None)
+        for got, pt in zip(answer, secret["new_pt"]):
+            expect = b"".join(best if b in swap else b for b in blocks_of(pt)) if best else None
+            if expect is not None and ecb(secret["ecb_key"]).decrypt(bytes.fromhex(got)) != expect:
+                return False
+        return len(answer) == len(secret["new_pt"])
+    if n == 2:
+        return bytes.fromhex(answer) == secret["p2_pt"]
+    if n == 3:
+        pt = ctr(secret["ctr_key"], secret["nonce"]).decrypt(bytes.fromhex(answer))
+        return pt == flip(secret["p3_pt"])
+    nums = inputs["problem 4"]["actual_num"]
+    expect = b"".join(flip(pt)[:8] + ps2.int2bytes(num) for pt, num in zip(secret["p4_pt"], nums))
+    pt = ctr(secret["ctr_key"], secret["nonce"]).decrypt(bytes.fromhex("".join(answer)))
+    return pt == expect
+
+def measure(fn: Callable[[], object], repeat: int) -> "tuple[float, int, object]":
+    '''
+    Best wall time of `repeat` runs of `fn`, then its peak Python heap use
+    from one more run under tracemalloc, and its result
+    '''
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    tracemalloc.start()
+    result = fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return best, peak, result
+
+def bench_size(blocks: int, repeat: int, write_input: str) -> "list[dict]":
+    start = time.perf_counter()
+    inputs, secret = gen_problem_set(blocks, seed=blocks)
+    print(f"generated {blocks} blocks per problem in {time.perf_counter() - start:.2f}s", file=sys.stderr)
+    if write_input:
+        with open(write_input, "w", encoding="utf-8") as f:
+            json.dump(inputs, f, indent=4)
+    answers = [ps2.answer1, ps2.answer2, ps2.answer3, ps2.answer4]
+    results = []
+    for n, answer in enumerate(answers, 1):
+        params = inputs[f"problem {n}"]
+        seconds, peak, result = measure(lambda: answer(params), repeat)
+        ok = check(n, result, inputs, secret)
+        results.append({
+            "phase": f"answer{n}",
+            "blocks": blocks,
+            "seconds": seconds,
+            "blocks_per_s": blocks / seconds if seconds else None,
+            "peak_bytes": peak,
+            "correct": ok,
+        })
+        print(f"answer{n} {blocks:>10} {seconds:10.4f}s {peak:>12} B peak {'ok' if ok else 'WRONG'}",
+              file=sys.stderr)
+    return results
+
+def check_reference() -> bool:
+    '''
+    Whether the answers to example-input.json still match example-output.json
+    '''
+    with open(HERE / "example-input.json", encoding="utf-8") as f:
+        inputs = json.load(f)
+    with open(HERE / "example-output.json", encoding="utf-8") as f:
+        expect = json.load(f)
+    return ps2.solve(inputs) == expect
+
+def git_commit() -> str:
+    try:
+        out = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                             text=True, cwd=HERE)
+        return out.stdout.strip()
+    except OSError:
+        return ""
+
+def compare(base: dict, new: dict):
+    '''
+    Print the speedup of each answer in `new` over the same answer in `base`
+    '''
+    old = {(r["phase"], r["blocks"]): r for r in base["results"]}
+    print(f"{'phase':8} {'blocks':>10} {'base s':>10} {'new s':>10} {'speedup':>8}")
+    for r in new["results"]:
+        b = old.get((r["phase"], r["blocks"]))
+        if b:
+            speedup = b["seconds"] / r["seconds"] if r["seconds"] else float("inf")
+            print(f"{r['phase']:8} {r['blocks']:>10} {b['seconds']:10.4f} {r['seconds']:10.4f} {speedup:7.2f}x")
+
+def main():
+    parser = ArgumentParser(description="Benchmark the ps2 answers")
+    parser.add_argument("--sizes", default="16,10K,100K", help="trade blocks per problem, comma separated, K/M suffixes")
+    parser.add_argument("--repeat", type=int, default=3, help="timed runs per answer (best is kept)")
+    parser.add_argument("--write-input", default="", metavar="FILE",
+                        help="also save the generated problem set (of the last size) as FILE")
+    parser.add_argument("-o", "--output", default="bench_results.json", help="JSON results file")
+    parser.add_argument("--compare", default="", metavar="BASE", help="results file to compare against")
+    args = parser.parse_args()
+
+    reference = check_reference()
+    print(f"example-input.json: {'ok' if reference else 'WRONG'}", file=sys.stderr)
+    results = []
+    for blocks in map(parse_size, args.sizes.split(",")):
+        results += bench_size(blocks, args.repeat, args.write_input)
+    report = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "reference_ok": reference,
+        "results": results,
+    }
+    with open(args.output, "w", encoding="utf-8") as f:
+        f.write(json.dumps(report, indent=4) + "\n")
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            compare(json.load(f), report)
+    if not reference or not all(r["correct"] for r in results):
+        sys.exit(1)
+
+if __name__ == "__main__": main()
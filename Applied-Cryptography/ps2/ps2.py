@@ -1,64 +1,70 @@
 #!/usr/bin/env python3
 
+import argparse
 import json
+import os
+import sys
+from collections import deque
+
+# helpers
+
+def xor_bytes(*bufs):
+    # xor whole buffers at once as big integers instead of byte by byte
+    # the result is as long as the shortest buffer
+    n = min(len(b) for b in bufs)
+    acc = 0
+    for b in bufs:
+        acc ^= int.from_bytes(memoryview(b)[:n], "big")
+    return acc.to_bytes(n, "big")
 
 # problem 1
 
+def swap_blocks(ct, to_swap, swap_ct):
+    # replace each 16 byte block of ct that is in the to_swap set with swap_ct,
+    # looking blocks up through a memoryview instead of reslicing ct
+    view = memoryview(ct)
+    blocks = range(0, len(ct), 16)
+    if len(swap_ct) != 16:
+        # no trade to swap in, so the blocks to swap are dropped
+        return b''.join(view[i:i + 16] for i in blocks if view[i:i + 16] not in to_swap)
+    # otherwise swap them in place in a copy of ct
+    out = bytearray(ct)
+    for i in blocks:
+        if view[i:i + 16] in to_swap:
+            out[i:i + 16] = swap_ct
+    return bytes(out)
+
 def answer1(params):
-    old_pt = bytes.fromhex(params["old_pt"])
-    old_ct = bytes.fromhex(params["old_ct"])
-    old_trades = []
-    n = len(old_pt) // 16
-    for _ in range(n):
-        old_trades.append((old_pt[0:1], old_pt[2:6], int(old_pt[8:16]), old_ct[:16]))
-        old_pt = old_pt[16:]
-        old_ct = old_ct[16:]
+    old_pt = memoryview(bytes.fromhex(params["old_pt"]))
+    old_ct = memoryview(bytes.fromhex(params["old_ct"]))
 
     op1 = bytes(params["op_1"], encoding="utf8")
     op2 = bytes(params["op_2"], encoding="utf8")
     co1 = bytes(params["co_1"], encoding="utf8")
     co2 = bytes(params["co_2"], encoding="utf8")
 
-    to_swap = []
+    to_swap = set()
     swap_ct = b''
     highest_shares = 0
-    # each item:
-    # 0: B/S symbol (bytes)
-    # 1: company stock ticker symbol (bytes)
-    # 2: number of shares (int)
-    # 3: corresponding ciphertext block (bytes)
-    for item in old_trades:
-        if item[0] == op1 and item[1] == co1:
-            to_swap.append(item[3])
-        if item[0] == op2 and item[1] == co2 and item[2] > highest_shares:
-            highest_shares = item[2]
-            swap_ct = item[3]
-
-    new_trades = params["new_trades"]
-    output = []
-
-    for nt in new_trades:
-        # decode the hex string to bytes
-        # since we haven't decoded new_trades
-        ct = bytes.fromhex(nt)
-        # build the correponding output element from an empty byte string
-        elem = b''
-        while ct:
-            # iterate over each 16 byte chunk
-            # since the trades are each 16 bytes
-            # check if we should swap the first 16 bytes of ct
-            if ct[:16] in to_swap:
-                # if so, add swap_ct
-                elem += swap_ct
-            else:
-                # otherwise, add the ciphertext as is
-                elem += ct[:16]
-            # drop the first 16 bytes from ct
-            ct = ct[16:]
-        # append hex encoded elem bytes to output
-        output.append(elem.hex())
-
-    return output
+    # each 16 byte trade:
+    # [0:1]: B/S symbol
+    # [2:6]: company stock ticker symbol
+    # [8:16]: number of shares
+    # and its ciphertext block is at the same offset in old_ct
+    for i in range(0, len(old_pt) // 16 * 16, 16):
+        trade = old_pt[i:i + 16]
+        if trade[0:1] == op1 and trade[2:6] == co1:
+            to_swap.add(bytes(old_ct[i:i + 16]))
+        if trade[0:1] == op2 and trade[2:6] == co2:
+            shares = int(bytes(trade[8:16]))
+            if shares > highest_shares:
+                highest_shares = shares
+                swap_ct = bytes(old_ct[i:i + 16])
+
+    # decode each new trade from hex, since we haven't decoded new_trades,
+    # and hex encode it again once its blocks are swapped
+    return [swap_blocks(bytes.fromhex(nt), to_swap, swap_ct).hex()
+            for nt in params["new_trades"]]
 
 # problem 2
 
@@ -66,25 +72,17 @@ def answer2(params):
     old_pt = bytes.fromhex(params["old_pt"])
     old_ct = bytes.fromhex(params["old_ct"])
     new_ct = bytes.fromhex(params["new_ct"])
-    res_bytes = []
     # xor
-    for i in range(len(new_ct)):
-        res_bytes.append(old_pt[i] ^ old_ct[i] ^ new_ct[i])
-    return bytes(res_bytes).hex()
+    return xor_bytes(old_pt, old_ct, new_ct).hex()
 
 # problem 3
 
 def answer3(params):
     ct = bytes.fromhex(params["todays_ct"])
-    new_bytes = []
-    for i in range(len(ct)):
-        # want to change each ciphertext's first byte: B <=> S
-        # "B" ^ "S" => 17
-        if not i % 16:
-            new_bytes.append(ct[i] ^ 17)
-        else:
-            new_bytes.append(ct[i])
-    return bytes(new_bytes).hex()
+    # want to change each ciphertext's first byte: B <=> S
+    # "B" ^ "S" => 17
+    mask = (b"\x11" + bytes(15)) * (len(ct) // 16 + 1)
+    return xor_bytes(ct, mask).hex()
 
 # problem 4
 
@@ -96,20 +94,12 @@ def int2bytes(n):
     return b
 
 def a4_helper(trade, expected_num, actual_num):
-    res = []
-    # change B <=> S
-    for i in range(8):
-        if i == 0:
-            res.append(trade[0] ^ 17)
-        else:
-            res.append(trade[i])
     expected_bytes = int2bytes(expected_num)
     desired_bytes = int2bytes(actual_num)
-
-    # change each byte of the number from expected to desired
-    for i in range(8):
-        res.append(expected_bytes[i] ^ desired_bytes[i] ^ trade[8 + i])
-    return bytes(res).hex()
+    # change B <=> S, leave the rest of the first 8 bytes alone,
+    # and change each byte of the number from expected to desired
+    mask = b"\x11" + bytes(7) + xor_bytes(expected_bytes, desired_bytes)
+    return xor_bytes(trade, mask).hex()
 
 def answer4(params):
     tl = [bytes.fromhex(x) for x in params["trade_list"]]
@@ -120,22 +110,88 @@ def answer4(params):
         ret.append(a4_helper(tl[i], en[i], an[i]))
     return ret
 
-# testing: reads the input from 'example-input.json'
-file = open('example-input.json')
-inputs_json = json.load(file)
-file.close()
-
-# submission: reads the input from sys.stdin
-# inputs_json = json.load(sys.stdin)
-
-# initialize and update the output dict
-output = {}
-output["problem 1"] = answer1(inputs_json["problem 1"])
-output["problem 2"] = answer2(inputs_json["problem 2"])
-output["problem 3"] = answer3(inputs_json["problem 3"])
-output["problem 4"] = answer4(inputs_json["problem 4"])
-
-# print output to ./output.json
-f = open('output.json', 'w')
-f.write(json.dumps(output, indent=4) + "\n")
-f.close()
+# solving
+
+def solve(inputs_json):
+    # initialize and update the output dict
+    output = {}
+    output["problem 1"] = answer1(inputs_json["problem 1"])
+    output["problem 2"] = answer2(inputs_json["problem 2"])
+    output["problem 3"] = answer3(inputs_json["problem 3"])
+    output["problem 4"] = answer4(inputs_json["problem 4"])
+    return output
+
+def solve_lines(lines):
+    # answer a batch of JSONL problem sets, one JSON output line for each
+    # input line, so a bad or blank line gets an error line instead of
+    # stopping the stream or shifting the answers after it
+    out = []
+    for line in lines:
+        try:
+            out.append(json.dumps(solve(json.loads(line))))
+        except Exception as e:
+            out.append(json.dumps({"error": f"{type(e).__name__}: {e}"}))
+    return out
+
+def batches(lines, size):
+    # group the lines into lists of up to size lines
+    batch = []
+    for line in lines:
+        batch.append(line)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def solve_stream(lines, out, jobs, batch_size=64):
+    # answer newline-delimited problem sets on a pool of jobs worker processes,
+    # writing the results in input order; only a few batches per worker are
+    # in flight at a time, so memory does not grow with the input
+    if jobs <= 1:
+        for batch in batches(lines, batch_size):
+            out.write("".join(o + "\n" for o in solve_lines(batch)))
+        return
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(jobs) as pool:
+        pending = deque()
+        for batch in batches(lines, batch_size):
+            pending.append(pool.submit(solve_lines, batch))
+            if len(pending) >= 4 * jobs:
+                out.write("".join(o + "\n" for o in pending.popleft().result()))
+        while pending:
+            out.write("".join(o + "\n" for o in pending.popleft().result()))
+
+def main():
+    parser = argparse.ArgumentParser(description="Problem set 2 solver")
+    parser.add_argument("--jsonl", nargs="?", const="-", metavar="FILE",
+                        help="stream one problem set per line from FILE (default: stdin) to stdout")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count() or 1,
+                        help="worker processes for --jsonl")
+    args = parser.parse_args()
+
+    if args.jsonl:
+        if args.jsonl == "-":
+            solve_stream(sys.stdin, sys.stdout, args.jobs)
+        else:
+            with open(args.jsonl, encoding="utf-8") as f:
+                solve_stream(f, sys.stdout, args.jobs)
+        return
+
+    # testing: reads the input from 'example-input.json'
+    file = open('example-input.json')
+    inputs_json = json.load(file)
+    file.close()
+
+    # submission: reads the input from sys.stdin
+    # inputs_json = json.load(sys.stdin)
+
+    output = solve(inputs_json)
+
+    # print output to ./output.json
+    f = open('output.json', 'w')
+    f.write(json.dumps(output, indent=4) + "\n")
+    f.close()
+
+if __name__ == "__main__":
+    main()
@@ -2,6 +2,9 @@
 
 import argparse
 import csv
+import locale
+import os
+import socket
 import sys
 
 # Constants
@@ -19,59 +22,113 @@ MONTH_DICT = {
     '11': "Nov",
     '12': "Dec"
 }
+# byte-range shards of one file are at least this big
+MIN_SHARD_SIZE = 1 << 20
+# destination ports of the C2 traffic, as they appear in the log
+C2_PORTS = frozenset(['1337', '1338', '1339', '1340'])
+
+
+def ip_to_int(ip):
+    # dotted quad to a packed 32-bit int, which sorts like the address.
+    # Octets are read with int() as the log always was, so padded or
+    # zero-padded ones are accepted; raises ValueError unless there are
+    # four of them, each 0-255. inet_pton takes the common, canonical
+    # spelling quickly and agrees with int() on everything it accepts
+    try:
+        return int.from_bytes(socket.inet_pton(socket.AF_INET, ip), 'big')
+    except OSError:
+        pass
+    octets = ip.split('.')
+    if len(octets) != 4:
+        raise ValueError(f"not an IPv4 address: {ip!r}")
+    n = 0
+    for octet in map(int, octets):
+        if not 0 <= octet <= 255:
+            raise ValueError(f"not an IPv4 address: {ip!r}")
+        n = n << 8 | octet
+    return n
+
+
+def int_to_ip(n):
+    return socket.inet_ntoa(n.to_bytes(4, 'big'))
 
 
 class MalwareLogAnalyzer:
 
-    def __init__(self, filename):
+    def __init__(self, filename, start=0, end=None):
+        # with end set, only the lines starting in bytes [start, end) are read
         self.filename = filename
+        self.start = start
+        self.end = end
+        # C2 server IP (packed) -> bytes sent; its keys are the C2 servers
         self.ip_dict = {}
-        self.infected_ips = []
-        self.c2_servers = []
+        self.infected_ips = set()
         self.first_connection_timestamp = None
 
     def load_data(self):
         try:
-            with open(self.filename) as csv_file:
-                reader = csv.reader(csv_file, delimiter=',')
-                for row in reader:
-                    if self.is_row_valid(row):
-                        if row[4] in ['1337', '1338', '1339', '1340']:
-                            self.process_infected_system(row)
-                            self.process_c2_server(row)
-                            self.update_first_connection_timestamp(row[0])
+            if self.end is None:
+                with open(self.filename) as csv_file:
+                    self.load_rows(csv.reader(csv_file, delimiter=','))
+            else:
+                with open(self.filename, 'rb') as log_file:
+                    self.load_rows(csv.reader(self.range_lines(log_file), delimiter=','))
         except FileNotFoundError:
             print("Error! - File Not Found!")
             sys.exit(1)
 
-    def is_row_valid(self, row):
-        if len(row) < 6:
-            return False
+    def range_lines(self, log_file):
+        # the decoded lines whose first byte is in [start, end); the line
+        # running into start belongs to the shard before this one
+        if self.start:
+            log_file.seek(self.start - 1)
+            log_file.readline()
+        pos = log_file.tell()
+        encoding = locale.getpreferredencoding(False)
+        for line in log_file:
+            if pos >= self.end:
+                break
+            pos += len(line)
+            yield line.decode(encoding)
+
+    def load_rows(self, reader):
+        for row in reader:
+            fields = self.parse_row(row)
+            if fields:
+                timestamp, src_ip, dest_ip, data_bytes = fields
+                self.process_infected_system(src_ip)
+                self.process_c2_server(dest_ip, data_bytes)
+                self.update_first_connection_timestamp(timestamp)
+
+    def parse_row(self, row):
+        # (timestamp, source IP, destination IP, bytes) of a C2 connection,
+        # each parsed once, or None for other traffic and malformed rows
+        if len(row) < 6 or row[4] not in C2_PORTS:
+            return None
         try:
-            int(row[4])
-            int(row[5])
-            int(row[0])
-            return True
+            return int(row[0]), ip_to_int(row[1]), ip_to_int(row[2]), int(row[5])
         except ValueError:
-            return False
-
-    def process_infected_system(self, row):
-        src_ip = row[1]
-        if src_ip not in self.infected_ips:
-            self.infected_ips.append(src_ip)
-
-    def process_c2_server(self, row):
-        dest_ip = row[2]
-        data_bytes = int(row[5])
-        if dest_ip not in self.c2_servers:
-            self.c2_servers.append(dest_ip)
+            return None
+
+    def process_infected_system(self, src_ip):
+        self.infected_ips.add(src_ip)
+
+    def process_c2_server(self, dest_ip, data_bytes):
         self.ip_dict[dest_ip] = self.ip_dict.get(dest_ip, 0) + data_bytes
 
     def update_first_connection_timestamp(self, timestamp):
-        if self.first_connection_timestamp is None or int(timestamp) < int(
-                self.first_connection_timestamp):
+        if self.first_connection_timestamp is None or timestamp < self.first_connection_timestamp:
             self.first_connection_timestamp = timestamp
 
+    def merge(self, other):
+        # fold in the aggregate of the input that follows this one's, so
+        # merging in input order gives exactly the one-pass summary
+        self.infected_ips |= other.infected_ips
+        for dest_ip, data_bytes in other.ip_dict.items():
+            self.process_c2_server(dest_ip, data_bytes)
+        if other.first_connection_timestamp is not None:
+            self.update_first_connection_timestamp(other.first_connection_timestamp)
+
     def display_summary(self):
         print("Source File:", self.filename)
         self.display_infected_systems()
@@ -82,19 +139,18 @@ class MalwareLogAnalyzer:
 
     def display_infected_systems(self):
         print("Systems Infected:", len(self.infected_ips))
-        self.infected_ips.sort(key=lambda ip: tuple(map(int, ip.split('.'))))
-        print("Infected System IPs:\n", self.infected_ips)
+        print("Infected System IPs:\n", [int_to_ip(ip) for ip in sorted(self.infected_ips)])
 
     def display_c2_servers(self):
-        print("C2 Servers:", len(self.c2_servers))
-        self.c2_servers.sort(key=lambda ip: tuple(map(int, ip.split('.'))))
-        print("C2 Server IPs:\n", self.c2_servers)
+        print("C2 Servers:", len(self.ip_dict))
+        print("C2 Server IPs:\n", [int_to_ip(ip) for ip in sorted(self.ip_dict)])
 
     def display_data_totals(self):
+        # ties keep the order the servers were first seen in
         data_totals = sorted(self.ip_dict.items(),
                              key=lambda item: item[1],
                              reverse=True)
-        print("C2 Data Totals:", data_totals)
+        print("C2 Data Totals:", [(int_to_ip(ip), total) for ip, total in data_totals])
 
     def format_timestamp(self, timestamp):
         from datetime import datetime
@@ -107,16 +163,60 @@ class MalwareLogAnalyzer:
         return f"{year}-{month_str}-{day} {time} UTC"
 
 
+def shard_ranges(filename, shards):
+    # split filename into up to shards byte ranges, None for the whole file
+    size = os.path.getsize(filename)
+    shards = max(1, min(shards, size // MIN_SHARD_SIZE))
+    if shards == 1:
+        return [(0, None)]
+    bounds = [size * i // shards for i in range(shards + 1)]
+    return list(zip(bounds, bounds[1:]))
+
+
+def analyze_shard(filename, start, end):
+    analyzer = MalwareLogAnalyzer(filename, start, end)
+    analyzer.load_data()
+    return analyzer
+
+
+def analyze(filenames, jobs=1, shards=1):
+    # analyze each file, split into byte-range shards, on a pool of jobs
+    # worker processes, merging the partial aggregates in input order
+    tasks = [(f, start, end) for f in filenames for start, end in shard_ranges(f, shards)]
+    analyzer = MalwareLogAnalyzer(", ".join(filenames))
+    if jobs <= 1 or len(tasks) == 1:
+        for task in tasks:
+            analyzer.merge(analyze_shard(*task))
+        return analyzer
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(min(jobs, len(tasks))) as pool:
+        for part in pool.map(analyze_shard, *zip(*tasks)):
+            analyzer.merge(part)
+    return analyzer
+
+
 def main():
     parser = argparse.ArgumentParser(description="Analyzes network logs.")
-    parser.add_argument("filename", nargs='?', help="Log filename.")
+    parser.add_argument("filename", nargs='*', help="Log filename(s).")
+    parser.add_argument("--jobs", type=int, default=1,
+                        help="Worker processes (0: one per CPU).")
+    parser.add_argument("--shards", type=int, default=0,
+                        help="Byte-range shards per file (default: enough to keep the workers busy).")
     args = parser.parse_args()
     if not args.filename:
         print("Error! - No Log File Specified!")
         sys.exit(1)
+    if not all(os.path.isfile(f) for f in args.filename):
+        print("Error! - File Not Found!")
+        sys.exit(1)
 
-    analyzer = MalwareLogAnalyzer(args.filename)
-    analyzer.load_data()
+    if len(args.filename) == 1 and args.jobs == 1 and args.shards <= 1:
+        analyzer = MalwareLogAnalyzer(args.filename[0])
+        analyzer.load_data()
+    else:
+        jobs = args.jobs or os.cpu_count() or 1
+        shards = args.shards or -(-jobs // len(args.filename))
+        analyzer = analyze(args.filename, jobs, shards)
     analyzer.display_summary()
 
 